@@ -0,0 +1,209 @@
+"""Keystroke-replay benchmarks for texteditpad.
+
+Replays scripted key streams against a Textbox drawing into a
+VirtualWindow, so no terminal is needed, and reports per-command
+latency percentiles and the number of curses calls per command.
+
+    python benchmark.py                      # every document/scenario
+    python benchmark.py -d 10k -s typing     # a single combination
+    python benchmark.py --json bench.json    # save the results
+    python benchmark.py --baseline bench.json
+                                             # exit 1 on regressions
+"""
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import curses
+import curses.ascii
+import json
+import sys
+import time
+
+import texteditpad
+
+try:
+    clock = time.perf_counter
+except AttributeError:
+    clock = time.time
+
+
+def small_doc():
+    return '\n'.join('%4d  The quick brown fox jumps over the lazy dog.' % i
+                     for i in range(50))
+
+
+def lines_doc():
+    return '\n'.join('%6d  lorem ipsum dolor sit amet, consectetur '
+                     'adipiscing elit %s' % (i, 'x' * (i % 40))
+                     for i in range(10000))
+
+
+def long_line_doc():
+    record = '{"id": 12345, "name": "value", "tags": ["a", "b"]}, '
+    return '[' + record * (1000000 // len(record)) + ']'
+
+
+DOCUMENTS = {
+    'small': small_doc,
+    '10k': lines_doc,
+    'longline': long_line_doc,
+}
+
+
+def to_middle(tb):
+    "Put the cursor in the middle of the document (not measured)."
+    for _ in range(tb.nlines // 2):
+        tb.do_command(curses.KEY_DOWN)
+
+
+def typing(tb, n):
+    to_middle(tb)
+    return [[ord('a') + i % 26] for i in range(n)]
+
+
+def pasting(tb, n):
+    to_middle(tb)
+    chunk = ''.join('pasted line %d with some text\n' % i for i in range(1700))
+    keys = [ord(c) for c in chunk]
+    paste = (list(texteditpad._PASTE_START) + keys
+             + list(texteditpad._PASTE_END))
+    return [paste] * max(n // 500, 1)
+
+
+def scrolling(tb, n):
+    return ([[curses.KEY_DOWN]] * n + [[curses.KEY_UP]] * n)
+
+
+def deleting(tb, n):
+    to_middle(tb)
+    return ([[curses.KEY_BACKSPACE]] * (n // 2)
+            + [[curses.ascii.EOT]] * (n // 2))
+
+
+SCENARIOS = {
+    'typing': typing,
+    'pasting': pasting,
+    'scrolling': scrolling,
+    'deleting': deleting,
+}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    k = min(int(round(p / 100 * (len(values) - 1))), len(values) - 1)
+    return values[k]
+
+
+def ncalls(win):
+    "Number of drawing calls made on win so far."
+    return sum(n for name, n in win.calls.items()
+               if name not in ('getch', 'get_wch', 'nodelay'))
+
+
+def run(document, scenario, n, height, width):
+    "Replay one scenario and return its statistics."
+
+    win = texteditpad.VirtualWindow(height, width)
+    tb = texteditpad.Textbox(win, text=DOCUMENTS[document]())
+    commands = SCENARIOS[scenario](tb, n)
+
+    latencies, calls = [], []
+    for keys in commands:
+        before = ncalls(win)
+        t = clock()
+        tb.feed(keys)
+        latencies.append((clock() - t) * 1e6)
+        calls.append(ncalls(win) - before)
+
+    return {
+        'document': document,
+        'scenario': scenario,
+        'commands': len(commands),
+        'p50_us': percentile(latencies, 50),
+        'p90_us': percentile(latencies, 90),
+        'p99_us': percentile(latencies, 99),
+        'max_us': max(latencies),
+        'calls_per_cmd': sum(calls) / len(calls),
+        'max_calls': max(calls),
+    }
+
+
+def report(results, out=sys.stdout):
+    header = ('%-9s %-10s %6s %9s %9s %9s %10s %9s %9s'
+              % ('document', 'scenario', 'cmds', 'p50(us)', 'p90(us)',
+                 'p99(us)', 'max(us)', 'calls/cmd', 'max calls'))
+    print(header, file=out)
+    print('-' * len(header), file=out)
+    for r in results:
+        print('%-9s %-10s %6d %9.1f %9.1f %9.1f %10.1f %9.1f %9d'
+              % (r['document'], r['scenario'], r['commands'], r['p50_us'],
+                 r['p90_us'], r['p99_us'], r['max_us'],
+                 r['calls_per_cmd'], r['max_calls']), file=out)
+
+
+def regressions(results, baseline, tolerance):
+    """Compare against saved results.  Latencies may grow by the
+    tolerance factor; curses call counts are deterministic and may not
+    grow at all."""
+
+    old = dict(((r['document'], r['scenario']), r) for r in baseline)
+    found = []
+    for r in results:
+        b = old.get((r['document'], r['scenario']))
+        if b is None:
+            continue
+        for key in ('p50_us', 'p99_us'):
+            if r[key] > b[key] * tolerance:
+                found.append('%s/%s: %s %.1f -> %.1f'
+                             % (r['document'], r['scenario'], key,
+                                b[key], r[key]))
+        for key in ('calls_per_cmd', 'max_calls'):
+            if r[key] > b[key] + 1e-9:
+                found.append('%s/%s: %s %.1f -> %.1f'
+                             % (r['document'], r['scenario'], key,
+                                b[key], r[key]))
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-d', '--document', action='append',
+                        choices=sorted(DOCUMENTS),
+                        help='document to use (repeatable, default: all)')
+    parser.add_argument('-s', '--scenario', action='append',
+                        choices=sorted(SCENARIOS),
+                        help='scenario to replay (repeatable, default: all)')
+    parser.add_argument('-n', type=int, default=2000,
+                        help='keystrokes per scenario (default: 2000)')
+    parser.add_argument('--size', default='24x80',
+                        help='window size as LINESxCOLS (default: 24x80)')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline',
+                        help='compare against results saved with --json')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='allowed latency growth factor (default: 1.5)')
+    args = parser.parse_args(argv)
+
+    height, width = (int(v) for v in args.size.split('x'))
+    results = [run(d, s, args.n, height, width)
+               for d in args.document or sorted(DOCUMENTS)
+               for s in args.scenario or sorted(SCENARIOS)]
+    report(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for line in found:
+            print('REGRESSION ' + line)
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
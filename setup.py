@@ -13,13 +13,15 @@ setup(
     author_email='yus.sakamoto@gmail.com',
     license='MIT',
     keywords='curses terminal text edit box pad',
+    python_requires='>=3.7',
     classifiers=[
         'Intended Audience :: End Users/Desktop',
         'Environment :: Console :: Curses',
         'Operating System :: MacOS :: MacOS X',
         'Operating System :: POSIX',
         'Natural Language :: English',
-        'Programming Language :: Python :: 2.7',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
         'Topic :: Terminals',
         'Topic :: Utilities',
         'Topic :: Text Editors'
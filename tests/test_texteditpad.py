@@ -0,0 +1,537 @@
+"""Headless regression tests, run with pytest."""
+
+import asyncio
+import curses.ascii
+import gc
+import os
+import random
+import threading
+import time
+
+import texteditpad
+from texteditpad import Textbox, VirtualWindow
+
+
+def make_box(text='', nlines=10, ncols=40, **kwargs):
+    win = VirtualWindow(nlines, ncols)
+    return (Textbox(win, text=text, **kwargs), win)
+
+
+def test_transform_larger_than_undo_limit_is_undone():
+    text = '\n'.join('line %d' % (i % 97) for i in range(2000))
+    (box, win) = make_box(text, undo_limit=1000)
+    assert box.transform(texteditpad.SortLines())
+    assert box.text.getvalue() == '\n'.join(sorted(text.split('\n')))
+    box.undo()
+    assert box.text.getvalue() == text
+
+
+def test_undo_limit_drops_only_older_records():
+    journal = texteditpad.UndoJournal(limit=10)
+    journal.record(0, 0, '', 'abc')
+    journal.seal()
+    journal.record(0, 0, 'abc', 'x' * 20)
+    assert [rec[3] for rec in journal.undos] == ['x' * 20]
+
+
+def test_regex_replace_in_region_sees_the_whole_line():
+    (box, win) = make_box('abc abc\nabc')
+    box.goto_line(0, 4)
+    box.set_mark()
+    box.goto_line(1, 3)
+    assert box.replace_all('^abc', 'X', regex=True, region=True) == 1
+    assert box.text.getvalue() == 'abc abc\nX'
+    box.undo()
+    assert box.replace_all(r'(?<=c )\w+', r'<\g<0>>', regex=True) == 1
+    assert box.text.getvalue() == 'abc <abc>\nabc'
+
+
+def test_replace_all_larger_than_undo_limit_is_undone():
+    text = '\n'.join('foo %d' % i for i in range(1000))
+    (box, win) = make_box(text, undo_limit=100)
+    assert box.replace_all('foo', 'bar') == 1000
+    box.undo()
+    assert box.text.getvalue() == text
+
+
+def run_aedit(box, seconds=0.05):
+    "Run box.aedit for a while on a fresh event loop, reading a pipe."
+
+    (r, w) = os.pipe()
+
+    async def main():
+        task = asyncio.ensure_future(box.aedit(fd=r))
+        await asyncio.sleep(seconds)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    try:
+        asyncio.run(main())
+    finally:
+        os.close(r)
+        os.close(w)
+
+
+def test_aedit_refreshes_after_typed_keys():
+    (box, win) = make_box()
+    win.push_keys([ord('a'), ord('b')])
+    run_aedit(box)
+    assert win.lines()[0].startswith('ab')
+    assert win.calls.get('refresh', 0) >= 1
+
+
+def test_aedit_processes_keys_held_during_a_transform_first():
+    (box, win) = make_box()
+    box._held = [ord('a')]  # read by _cancelled while a transform ran
+    win.push_keys([ord('b')])
+    run_aedit(box)
+    assert box.text.getvalue() == 'ab'
+
+
+def test_follow_does_not_wait_for_a_blocking_iterator():
+    release = threading.Event()
+
+    def tail():
+        yield 'first\n'
+        release.wait()
+        yield 'second\n'
+
+    (r, w) = os.pipe()
+    try:
+        (box, win) = make_box(input_fd=r)
+        box.follow(tail())
+        box._wait_follow()
+        assert box.text.getvalue() == 'first\n'
+        os.write(w, b'x')  # a key typed while the iterator blocks
+        box._wait_follow()
+        assert box.following is not None
+        release.set()
+        while box.following is not None:
+            box._wait_follow()
+        assert box.text.getvalue() == 'first\nsecond\n'
+    finally:
+        release.set()
+        os.close(r)
+        os.close(w)
+
+
+def test_kill_and_copy_region_on_a_mapped_file(tmp_path):
+    path = tmp_path / 'lines.txt'
+    path.write_text(''.join('line %d\n' % i for i in range(100)))
+    box = Textbox.from_file(VirtualWindow(10, 40), str(path))
+    box.goto_line(50, 2)
+    box.set_mark()
+    box.goto_line(51, 3)
+    box.copy_region()
+    assert box.kill_ring.yank() == 'ne 50\nlin'
+    box.set_mark()
+    box.goto_line(50, 2)
+    box.kill_region()
+    assert box.kill_ring.yank() == 'ne 50\nlin'
+    assert box.text.get(50) == 'lie 51'
+    box.yank()
+    box.yank_pop()
+    assert [box.text.get(50), box.text.get(51)] == ['line 50', 'line 51']
+
+
+def test_transform_and_stats_of_the_region():
+    (box, win) = make_box('d\nc\n  b\na\nz')
+    box.goto_line(1)
+    box.set_mark()
+    box.goto_line(4)
+    assert box.stats(region=True) == {'lines': 3, 'words': 3, 'chars': 7}
+    assert box.transform(texteditpad.SortLines(), region=True)
+    assert box.text.getvalue() == 'd\n  b\na\nc\nz'
+    assert box.transform(texteditpad.Reindent(2, 4))
+    assert box.text.getvalue() == 'd\n    b\na\nc\nz'
+
+
+def test_macro_leaves_out_the_keys_that_end_it():
+    (box, win) = make_box()
+    C_X, C_U = 0x18, 0x15
+    box.feed([C_X, ord('('), ord('a'), C_U, ord('2'), C_X, ord(')')])
+    assert box.macro == [ord('a')]
+    box.feed([C_U, ord('3'), C_X, ord('e')])
+    assert box.text.getvalue() == 'aaaa'
+
+
+def test_macro_replay_moves_the_cursor_once():
+    (box, win) = make_box()
+    box.feed([0x18, ord('('), ord('a'), 0x02, 0x06, 0x18, ord(')')])
+    moves = win.calls.get('move', 0)
+    box.call_macro(1000)
+    box.render_all()
+    assert box.text.getvalue() == 'a' * 1001
+    assert win.calls['move'] - moves <= 5
+
+
+def _paste(s):
+    return (list(texteditpad._PASTE_START) + [ord(c) for c in s]
+            + list(texteditpad._PASTE_END))
+
+
+def test_paste_is_inserted_verbatim_with_newlines_normalized():
+    (box, win) = make_box()
+    box.feed(_paste('a\tb\r\nc\rd\ne'))
+    assert box.text.getvalue() == 'a\tb\nc\nd\ne'
+    # a CR LF split between two batches
+    keys = _paste('x\r\ny')
+    box.feed(keys[:8])
+    box.feed(keys[8:])
+    assert box.text.getvalue() == 'a\tb\nc\nd\nex\ny'
+
+
+def test_paste_overwrites_in_overwrite_mode():
+    (box, win) = make_box('abcdef\nxyz', insert_mode=False)
+    box.feed(_paste('12'))
+    assert box.text.getvalue() == '12cdef\nxyz'
+    box.feed(_paste('3456789'))
+    assert box.text.getvalue() == '123456789\nxyz'
+
+
+def test_incremental_search_narrows_to_the_longer_query():
+    text = '\n'.join('ab%d abc' % i for i in range(3000))
+    (box, win) = make_box(text)
+    box.feed([0x13, ord('a'), ord('b'), ord('c')])  # ^s abc
+    assert box.search.query == 'abc'
+    assert len(box.search.matches) == 3000
+    assert box.vpos == (0, 4)
+    box.feed([0x13])
+    assert box.vpos == (1, 4)
+    box.feed([0x08, 0x08])  # back to the first match of ab
+    assert box.search.query == 'ab'
+    assert len(box.search.matches) == 6000
+    assert box.vpos == (0, 0)
+
+
+def test_search_picks_up_lines_indexed_later(tmp_path, monkeypatch):
+    monkeypatch.setattr(texteditpad.MappedBuffer, 'CHUNK', 1000)
+    path = tmp_path / 'lines.txt'
+    path.write_text(''.join('line %d\n' % i for i in range(1000)))
+    box = Textbox.from_file(VirtualWindow(10, 40), str(path))
+    box.feed([0x13, ord('9'), ord('9')])  # ^s 99
+    assert not box.text.complete
+    while not box.text.complete:
+        box._load_more()
+    expected = [(i, col) for i, s in enumerate(box.text)
+                for col in range(len(s)) if s.startswith('99', col)]
+    assert [texteditpad._unpacked(p)
+            for p in box.search.matches] == expected
+    box.feed([0x08])  # back to the matches of 9
+    assert len(box.search.matches) == sum(
+        s.count('9') for s in box.text)
+
+
+def test_word_wrap_keeps_the_space_after_a_full_row():
+    (box, win) = make_box('ab cd ef gh ij', nlines=3, ncols=8,
+                          word_wrap=True)
+    assert win.lines()[:2] == ['ab cd ef', 'gh ij   ']
+    box.move_end()
+    assert box.vpos == (0, 8)
+    assert box.ppos == (0, 7)
+    box.move_right()
+    assert box.ppos == (1, 0)
+
+
+def test_journal_replay_rebuilds_the_text(tmp_path):
+    path = str(tmp_path / 'journal')
+    journal = texteditpad.RecoveryJournal(path, interval=0.01)
+    (box, win) = make_box('one\ntwo\nthree', journal=journal)
+    box.feed([ord(c) for c in 'zero\n'])
+    box.goto_line(2)
+    box.feed([0x0b, 0x0b])  # ^k ^k: clear the line, then join the next
+    box.insert_text('2二')
+    box.transform(texteditpad.LineMap(str.upper))
+    journal.close()
+    # a record cut short by the crash is ignored
+    with open(path, 'a') as f:
+        f.write('[0, 0, 0, "lost')
+    recovered = Textbox.recover(VirtualWindow(10, 40), path,
+                                text='one\ntwo\nthree')
+    assert recovered.text.getvalue() == box.text.getvalue()
+    recovered.undo()
+    assert recovered.text.getvalue() == 'zero\none\n2二three'
+
+
+def test_typing_is_undone_and_redone_as_one_edit():
+    (box, win) = make_box('x')
+    box.feed([ord(c) for c in 'hello '])
+    box.feed([0x02, ord('!')])  # ^b moves, so the ! is a new edit
+    box.undo()
+    assert box.text.getvalue() == 'hello x'
+    box.undo()
+    assert box.text.getvalue() == 'x'
+    box.redo()
+    assert box.text.getvalue() == 'hello x'
+    box.render_all()
+    assert win.lines()[0].startswith('hello x')
+
+
+def test_mapped_buffer_deletes_many_lines_at_once(tmp_path):
+    path = tmp_path / 'lines.txt'
+    lines = ['line %d' % i for i in range(50000)]
+    path.write_text('\n'.join(lines) + '\n')
+    buf = texteditpad.MappedBuffer(str(path))
+    while not buf.complete:
+        buf.index_more()
+    n = sum(len(s) + 1 for s in lines[100:40100])
+    start = time.time()
+    old = buf.replace(100, 2, n, 'X')
+    assert time.time() - start < 1
+    assert old == '\n'.join(lines[100:40100])[2:] + '\nli'
+    assert buf.get(100) == 'liXne 40100'
+    assert len(buf) == len(lines) + 1 - 40000
+    assert buf.get(101) == 'line 40101'
+
+
+def test_follow_keeps_reading_a_growing_file(tmp_path):
+    path = tmp_path / 'log'
+    path.write_text('one\n')
+    (r, w) = os.pipe()
+    try:
+        (box, win) = make_box(input_fd=r)
+        box.FOLLOW_POLL = 0.01
+        box.follow(open(str(path)))
+        gc.collect()  # the file object must stay open
+        box._wait_follow()
+        box._wait_follow()  # at the end: waits, but keeps following
+        assert box.following is not None
+        with open(str(path), 'a') as f:
+            f.write('two\n')
+        box._wait_follow()
+        assert box.text.getvalue() == 'one\ntwo\n'
+    finally:
+        os.close(r)
+        os.close(w)
+
+
+def test_wide_line_keeps_its_cells_when_lines_move():
+    (box, win) = make_box('\n'.join(['x'] * 50 + ['中文字x', 'y']),
+                          nlines=5, ncols=6)
+    # off screen: known to be wide, measured once it is shown
+    assert 50 in box._wide and box._wide.get(50) is None
+    box.do_command(10)
+    box.do_command(10)
+    box.goto_line(52, 3)
+    box.render()
+    assert win.lines()[1:3] == ['中文字', 'x     ']
+    assert box.ppos == (2, 0)
+    box.goto_line(2)
+    box.do_command(8)
+    box.do_command(8)
+    box.goto_line(50, 3)
+    box.render()
+    assert win.lines()[1:3] == ['中文字', 'x     ']
+    assert box.ppos == (2, 0)
+
+
+def test_typed_run_ends_a_yank_as_single_keys_do():
+    keys = [curses.ascii.EM, ord('a'), ord('b'), curses.ascii.ESC, ord('y')]
+    results = []
+    for batched in (True, False):
+        (box, win) = make_box('one two')
+        box.kill_ring.push('OLD')
+        box.kill_ring.push('NEW')
+        if batched:
+            box.feed(keys)
+        else:
+            for ch in keys:
+                box.feed([ch])
+        results.append(box.text.getvalue())
+    assert results == ['NEWabone two'] * 2
+
+
+def test_highlighting_follows_a_block_across_unseen_lines():
+    highlighter = texteditpad.RegexHighlighter([('#.*', 1)],
+                                               [('/\\*', '\\*/', 3)])
+    (box, win) = make_box('/*\n' + 'x\n' * 300 + '*/ y # z', nlines=5,
+                          ncols=10, highlighter=highlighter)
+    box.goto_line(301)
+    box.render()
+    assert win.lines()[2] == '*/ y # z  '
+    assert win.attrs[1:3] == [{0: 3}, {0: 3, 1: 3, 5: 1, 6: 1, 7: 1}]
+    # deleting the opening of the block recolours the lines shown
+    box.goto_line(0)
+    box.do_command(curses.ascii.EOT)
+    box.do_command(curses.ascii.EOT)
+    box.goto_line(301)
+    box.render()
+    assert win.attrs[1:3] == [{}, {5: 1, 6: 1, 7: 1}]
+
+
+def test_replace_in_a_region_far_into_a_mapped_file(tmp_path):
+    path = tmp_path / 'lines.txt'
+    path.write_text(''.join('line %d\n' % i for i in range(20000)))
+    box = Textbox.from_file(VirtualWindow(10, 40), str(path))
+    box.goto_line(19990, 2)
+    box.set_mark()
+    box.goto_line(19992, 2)
+    assert box.replace_all('ne', 'NE', region=True) == 2
+    assert [box.text.get(i) for i in range(19989, 19994)] == [
+        'line 19989', 'liNE 19990', 'liNE 19991', 'line 19992',
+        'line 19993']
+
+
+def test_buffers_agree_on_random_edits(tmp_path):
+    rng = random.Random(6)
+    text = '\n'.join('line %d %s' % (i, '中' * (i % 3)) for i in range(300))
+    path = tmp_path / 'lines.txt'
+    path.write_text(text, encoding='utf-8')
+    mapped = texteditpad.MappedBuffer(str(path))
+    mapped.CHUNK = 500
+    while not mapped.complete:
+        mapped.index_more()
+    buffers = [texteditpad.RopeBuffer(text), texteditpad.ListBuffer(text),
+               mapped]
+    for step in range(200):
+        lines = text.split('\n')
+        line = rng.randrange(len(lines))
+        col = rng.randint(0, len(lines[line]))
+        n = rng.randint(0, 30)
+        s = rng.choice(['', 'x', 'a\nb', '\n\n', 'wide 文字\n'])
+        off = sum(len(l) + 1 for l in lines[:line]) + col
+        old = text[off:off + n]
+        text = text[:off] + s + text[off + n:]
+        for buf in buffers:
+            assert buf.replace(line, col, n, s) == old
+    lines = text.split('\n')
+    for buf in buffers:
+        assert buf.getvalue() == text
+        assert len(buf) == len(lines)
+        assert list(buf.line_lengths(5)) == [len(l) for l in lines[5:]]
+        assert list(buf.lines_from(7, 20)) == lines[7:20]
+        assert [i for i, l in buf.wide_lines(3)] == [
+            i for i, l in enumerate(lines)
+            if i >= 3 and texteditpad._MAYBE_WIDE.search(l)]
+        assert buf.get(10, 2, 5) == lines[10][2:5]
+        assert buf.offset(12, 1) == sum(len(l) + 1 for l in lines[:12]) + 1
+    mapped.close()
+
+
+def test_row_index_matches_a_list():
+    rng = random.Random(7)
+    counts = [rng.randint(1, 3) for _ in range(700)]
+    index = texteditpad.RowIndex(counts)
+    for step in range(300):
+        op = rng.random()
+        i = rng.randrange(len(counts))
+        if op < 0.3:
+            index[i] = counts[i] = rng.randint(1, 3)
+        elif op < 0.5:
+            index.insert(i, 2)
+            counts.insert(i, 2)
+        elif op < 0.7 and len(counts) > 1:
+            assert index.pop(i) == counts.pop(i)
+        else:
+            j = min(i + rng.randint(0, 600), len(counts))
+            new = [rng.randint(1, 3) for _ in range(rng.randint(0, 600))]
+            index.splice(i, j, new)
+            counts[i:j] = new
+    assert list(index) == counts
+    assert index.total() == sum(counts)
+    for i in range(0, len(counts), 37):
+        rows = sum(counts[:i])
+        assert index.rows_before(i) == rows
+        assert index.line_at(rows + counts[i] - 1) == (i, counts[i] - 1)
+
+
+def test_typing_repaints_only_the_rows_it_changes():
+    (box, win) = make_box('one\ntwo\nthree')
+    win.calls.clear()
+    box.do_command(ord('x'))
+    assert win.calls == {'move': 2, 'addnstr': 1}
+    assert win.lines()[:3] == [s.ljust(40) for s in ('xone', 'two', 'three')]
+    # a new line opens with insdelln; its two rows are drawn
+    win.calls.clear()
+    box.do_command(curses.ascii.NL)
+    assert win.calls.get('insdelln') == 1
+    assert win.calls.get('addnstr') == 2
+    assert [s.rstrip() for s in win.lines()[:4]] == ['x', 'one', 'two',
+                                                    'three']
+
+
+def test_moving_past_the_bottom_scrolls_the_terminal():
+    (box, win) = make_box('\n'.join('line %d' % i for i in range(30)),
+                          nlines=4, ncols=20)
+    for _ in range(3):
+        box.do_command(curses.KEY_DOWN)
+    win.calls.clear()
+    box.do_command(curses.KEY_DOWN)
+    assert win.calls.get('scrl') == 1
+    # only the row scrolled in is drawn
+    assert win.calls.get('addnstr', 0) == 1
+    assert win.lines() == [('line %d' % i).ljust(20) for i in range(1, 5)]
+    assert box.ppos == (3, 0)
+
+
+def test_page_down_and_up_keep_the_cursor_row():
+    (box, win) = make_box('\n'.join('line %d' % i for i in range(30)),
+                          nlines=4, ncols=20)
+    box.do_command(curses.KEY_DOWN)
+    box.do_command(curses.KEY_NPAGE)
+    assert win.lines()[0].rstrip() == 'line 3'
+    assert (box.vpos, box.ppos) == ((4, 0), (1, 0))
+    box.do_command(curses.KEY_PPAGE)
+    assert win.lines()[0].rstrip() == 'line 0'
+    assert (box.vpos, box.ppos) == ((1, 0), (1, 0))
+    box.do_command(curses.KEY_END)
+    assert box.vpos[0] == 29
+    assert win.lines()[box.ppos[0]].rstrip() == 'line 29'
+
+
+def test_wide_characters_take_two_cells():
+    (box, win) = make_box('a中b文cd', nlines=3, ncols=6)
+    assert win.lines()[:2] == ['a中b文', 'cd    ']
+    for _ in range(5):
+        box.do_command(curses.KEY_RIGHT)
+    assert (box.vpos, box.ppos) == ((0, 5), (1, 1))
+    box.do_command(curses.ascii.BS)
+    assert win.lines()[:2] == ['a中b文', 'd     ']
+    box.do_command(curses.KEY_LEFT)
+    assert (box.vpos, box.ppos) == ((0, 3), (0, 4))
+
+
+def test_resize_reflows_and_keeps_the_cursor_on_its_character():
+    text = 'abcdefghijklmno\nxy\n' + '\n'.join('l%d' % i for i in range(50))
+    (box, win) = make_box(text, nlines=4, ncols=10)
+    box.goto_line(1, 1)
+    box.render()
+    win.__init__(4, 6)  # the terminal got narrower
+    box.do_command(curses.KEY_RESIZE)
+    assert win.lines() == ['abcdef', 'ghijkl', 'mno   ', 'xy    ']
+    assert (box.vpos, box.ppos) == ((1, 1), (3, 1))
+    while box._stale is not None:
+        box._reflow_more()
+    assert box.nlines == 3 + 1 + 50
+
+
+def test_views_of_a_document_follow_each_others_edits():
+    (first, win) = make_box('one\ntwo\nthree', nlines=3, ncols=10)
+    other_win = VirtualWindow(3, 10)
+    other = Textbox(other_win, document=first.document)
+    other.goto_line(2, 5)
+    other.render()
+    first.do_command(curses.ascii.NL)
+    assert [s.rstrip() for s in win.lines()] == ['', 'one', 'two']
+    assert [s.rstrip() for s in other_win.lines()] == ['two', 'three', '']
+    assert other.vpos == (3, 5)
+    first.undo()
+    other.render()
+    assert other.vpos == (2, 5)
+    assert other.text.getvalue() == 'one\ntwo\nthree'
+
+
+def test_metrics_count_keys_and_repainted_rows():
+    metrics = texteditpad.Metrics()
+    (box, win) = make_box('abc', metrics=metrics)
+    box.feed([ord('x'), ord('y'), curses.ascii.SOH])
+    assert metrics.keys == 3
+    assert metrics.percentile('^A', 50) is not None
+    assert metrics.percentile('^E', 50) is None
+    snapshot = metrics.snapshot()
+    assert snapshot['lines'] == 1 and snapshot['chars'] == 5
+    assert snapshot['rows'] == sum(n * k for n, k in
+                                   snapshot['repaints'].items())
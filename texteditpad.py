@@ -6,26 +6,2109 @@ from builtins import chr
 from builtins import range
 from builtins import object
 
+import os
+import re
 import sys
+import json
+import mmap
+import select
+import stat
+import time
+import queue
+import atexit
+import heapq
+import codecs
 import curses
 import curses.ascii
+import unicodedata
+import weakref
+import asyncio
+import threading
+import concurrent.futures
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from functools import partial
+from itertools import accumulate, chain
 # from six.moves import range
 
 import locale
 locale.setlocale(locale.LC_ALL, '')
 
+try:
+    _clock = time.perf_counter
+except AttributeError:
+    _clock = time.time
+
 def rectangle(win, uly, ulx, lry, lrx):
     """Draw a rectangle with corners at the provided upper-left
     and lower-right coordinates.
     """
-    win.vline(uly + 1, ulx, curses.ACS_VLINE, lry - uly - 1)
-    win.hline(uly, ulx + 1, curses.ACS_HLINE, lrx - ulx - 1)
-    win.hline(lry, ulx + 1, curses.ACS_HLINE, lrx - ulx - 1)
-    win.vline(uly + 1, lrx, curses.ACS_VLINE, lry - uly - 1)
-    win.addch(uly, ulx, curses.ACS_ULCORNER)
-    win.addch(uly, lrx, curses.ACS_URCORNER)
-    win.addch(lry, lrx, curses.ACS_LRCORNER)
-    win.addch(lry, ulx, curses.ACS_LLCORNER)
+    win.vline(uly + 1, ulx, curses.ACS_VLINE, lry - uly - 1)
+    win.hline(uly, ulx + 1, curses.ACS_HLINE, lrx - ulx - 1)
+    win.hline(lry, ulx + 1, curses.ACS_HLINE, lrx - ulx - 1)
+    win.vline(uly + 1, lrx, curses.ACS_VLINE, lry - uly - 1)
+    win.addch(uly, ulx, curses.ACS_ULCORNER)
+    win.addch(uly, lrx, curses.ACS_URCORNER)
+    win.addch(lry, lrx, curses.ACS_LRCORNER)
+    win.addch(lry, ulx, curses.ACS_LLCORNER)
+
+
+# maximum number of characters held by a single rope leaf
+_LEAF_SIZE = 512
+
+
+class _RopeNode(object):
+    "Immutable rope node; leaves hold text, inner nodes hold children."
+
+    __slots__ = ('left', 'right', 'text', 'length', 'newlines', 'height')
+
+    def __init__(self, left=None, right=None, text=None):
+        self.left = left
+        self.right = right
+        self.text = text
+        if text is not None:
+            self.length = len(text)
+            self.newlines = text.count('\n')
+            self.height = 1
+        else:
+            self.length = left.length + right.length
+            self.newlines = left.newlines + right.newlines
+            self.height = max(left.height, right.height) + 1
+
+
+def _rope_build(text):
+    "Build a balanced rope out of a string."
+
+    leaves = [_RopeNode(text=text[i:i + _LEAF_SIZE])
+              for i in range(0, len(text), _LEAF_SIZE)]
+
+    def build(lo, hi):
+        if hi - lo == 1:
+            return leaves[lo]
+        mid = (lo + hi) // 2
+        return _RopeNode(build(lo, mid), build(mid, hi))
+
+    return build(0, len(leaves)) if leaves else None
+
+
+def _rotate_left(node):
+    r = node.right
+    return _RopeNode(_RopeNode(node.left, r.left), r.right)
+
+
+def _rotate_right(node):
+    l = node.left
+    return _RopeNode(l.left, _RopeNode(l.right, node.right))
+
+
+def _rope_pair(a, b):
+    "Join two adjacent subtrees, merging small leaves."
+
+    if a.text is not None and b.text is not None \
+       and a.length + b.length <= _LEAF_SIZE:
+        return _RopeNode(text=a.text + b.text)
+    return _RopeNode(a, b)
+
+
+def _join_right(a, b):
+    "AVL join where a is taller than b."
+
+    if a.right.height <= b.height + 1:
+        t = _rope_pair(a.right, b)
+        if t.height <= a.left.height + 1:
+            return _RopeNode(a.left, t)
+        return _rotate_left(_RopeNode(a.left, _rotate_right(t)))
+    t = _RopeNode(a.left, _join_right(a.right, b))
+    if t.right.height <= a.left.height + 1:
+        return t
+    return _rotate_left(t)
+
+
+def _join_left(a, b):
+    "AVL join where b is taller than a."
+
+    if b.left.height <= a.height + 1:
+        t = _rope_pair(a, b.left)
+        if t.height <= b.right.height + 1:
+            return _RopeNode(t, b.right)
+        return _rotate_right(_RopeNode(_rotate_left(t), b.right))
+    t = _RopeNode(_join_left(a, b.left), b.right)
+    if t.left.height <= b.right.height + 1:
+        return t
+    return _rotate_right(t)
+
+
+def _rope_concat(a, b):
+    "Concatenate two ropes in O(log n)."
+
+    if a is None or a.length == 0:
+        return b
+    if b is None or b.length == 0:
+        return a
+    if a.height > b.height + 1:
+        return _join_right(a, b)
+    if b.height > a.height + 1:
+        return _join_left(a, b)
+    return _rope_pair(a, b)
+
+
+def _rope_split(node, off):
+    "Split a rope into the first off characters and the rest."
+
+    if node is None:
+        return None, None
+    if node.text is not None:
+        if off <= 0:
+            return None, node
+        if off >= node.length:
+            return node, None
+        return (_RopeNode(text=node.text[:off]),
+                _RopeNode(text=node.text[off:]))
+    if off <= node.left.length:
+        l, r = _rope_split(node.left, off)
+        return l, _rope_concat(r, node.right)
+    l, r = _rope_split(node.right, off - node.left.length)
+    return _rope_concat(node.left, l), r
+
+
+def _rope_patch(node, off, n, s):
+    """Replace n characters at off with s when the change stays within
+    one leaf.  Returns None if the slow path is needed."""
+
+    if node.text is not None:
+        text = node.text[:off] + s + node.text[off + n:]
+        if not text or len(text) > 2 * _LEAF_SIZE:
+            return None
+        return _RopeNode(text=text)
+    llen = node.left.length
+    if off + n <= llen and (off < llen or n > 0):
+        left = _rope_patch(node.left, off, n, s)
+        return left and _RopeNode(left, node.right)
+    if off >= llen:
+        right = _rope_patch(node.right, off - llen, n, s)
+        return right and _RopeNode(node.left, right)
+    return None
+
+
+def _rope_leaves(node, start=0, stop=None):
+    "Yield the leaf strings covering [start, stop)."
+
+    if node is None:
+        return
+    if stop is None:
+        stop = node.length
+    stack = [(node, 0)]
+    while stack:
+        node, off = stack.pop()
+        if off >= stop or off + node.length <= start:
+            continue
+        if node.text is not None:
+            yield node.text[max(start - off, 0):stop - off]
+        else:
+            stack.append((node.right, off + node.left.length))
+            stack.append((node.left, off))
+
+
+def _coalesce(pieces, size):
+    "Group a stream of strings into blocks of about size characters."
+
+    block, n = [], 0
+    for s in pieces:
+        block.append(s)
+        n += len(s)
+        if n >= size:
+            yield ''.join(block)
+            block, n = [], 0
+    if block:
+        yield ''.join(block)
+
+
+def _newline_joined(pieces):
+    "Yield the strings in pieces with newlines between them."
+
+    pieces = iter(pieces)
+    for s in pieces:
+        yield s
+        break
+    for s in pieces:
+        yield '\n'
+        yield s
+
+
+# characters that may take other than one terminal cell
+_MAYBE_WIDE = re.compile(u'[^\u0000-\u02ff]')
+_widths = {}
+
+
+def _char_width(ch):
+    "Number of terminal cells taken by the character ch."
+    w = _widths.get(ch)
+    if w is None:
+        if unicodedata.combining(ch) \
+           or unicodedata.category(ch) in ('Mn', 'Me', 'Cf'):
+            w = 0
+        elif unicodedata.east_asian_width(ch) in ('W', 'F'):
+            w = 2
+        else:
+            w = 1
+        _widths[ch] = w
+    return w
+
+
+def _text_width(s):
+    "Number of terminal cells taken by s."
+    if _MAYBE_WIDE.search(s) is None:
+        return len(s)
+    return sum(_char_width(ch) for ch in s)
+
+
+def _reversed_from(a, k):
+    "a[k:] reversed."
+    return a[:k - 1 if k else None:-1]
+
+
+class _Cells(object):
+
+    """Screen offsets (row * width + x) of the columns of one line that
+    holds wide or zero-width characters, wrapped at width cells.
+
+    Only the columns of those characters are stored, with their widths
+    and the offsets at which they start and end; the single-cell
+    characters between them take consecutive cells.  A wide character
+    that does not fit at the end of a row starts the next one, and a
+    zero-width character stays on the row of the one it combines with.
+
+    The entries form a gap buffer split at the last edit: the ones
+    before it hold absolute values, the ones after it (in reverse
+    order) are counted back from the end of the line, so typing in one
+    place does not touch the entries further on.
+    """
+
+    def __init__(self, width):
+        self.width = width
+        self.length = 0  # characters in the line
+        self.end = 0  # offset of the end of the line
+        # entries before the gap: column, width, start, end
+        self.head = (array('i'), array('b'), array('i'), array('i'))
+        # entries after the gap, last first: length - column, width,
+        # self.end - start, self.end - end
+        self.tail = (array('i'), array('b'), array('i'), array('i'))
+
+    def __len__(self):
+        return len(self.head[0]) + len(self.tail[0])
+
+    @classmethod
+    def measure(cls, s, width):
+        "Cells of the line s, or None if every character takes one cell."
+        cells = cls(width)
+        cells.replace(0, 0, s)
+        return cells if len(cells) else None
+
+    @classmethod
+    def blank(cls, width, length):
+        "Cells of a line of length single-cell characters."
+        cells = cls(width)
+        cells.length = cells.end = length
+        return cells
+
+    def _place(self, d, w):
+        """Start and end offsets of a character of width w following a
+        character that ends at offset d."""
+        if w == 0:
+            return (d - 1 if d and d % self.width == 0 else d), d
+        x = d % self.width
+        if x and x + w > self.width:
+            d += self.width - x
+        return d, d + min(w, self.width)
+
+    def _take_tail(self, j):
+        """Remove the entries after the gap from index j of the tail
+        arrays on, and return them in order with absolute values."""
+        L, E = self.length, self.end
+        cols, widths, starts, ends = (_reversed_from(a, j) for a in self.tail)
+        for a in self.tail:
+            del a[j:]
+        return (array('i', [L - c for c in cols]), widths,
+                array('i', [E - s for s in starts]),
+                array('i', [E - e for e in ends]))
+
+    def _move_gap(self, col):
+        "Move the gap to just before the first entry at or after col."
+        head, tail, L, E = self.head, self.tail, self.length, self.end
+        k = bisect_left(head[0], col)
+        if k < len(head[0]):
+            cols, widths, starts, ends = (_reversed_from(a, k) for a in head)
+            tail[0].extend([L - c for c in cols])
+            tail[1].extend(widths)
+            tail[2].extend([E - s for s in starts])
+            tail[3].extend([E - e for e in ends])
+            for a in head:
+                del a[k:]
+        j = bisect_right(tail[0], L - col)
+        if j < len(tail[0]):
+            for a, b in zip(head, self._take_tail(j)):
+                a.extend(b)
+
+    def _find(self, col):
+        """The entry with the largest column not after col, as (column,
+        width, start, end), or None."""
+        tail = self.tail
+        if tail[0] and self.length - tail[0][-1] <= col:
+            j = bisect_left(tail[0], self.length - col)
+            return (self.length - tail[0][j], tail[1][j],
+                    self.end - tail[2][j], self.end - tail[3][j])
+        k = bisect_right(self.head[0], col) - 1
+        if k < 0:
+            return None
+        return tuple(a[k] for a in self.head)
+
+    def _end_before(self, col):
+        "Offset at which the character before column col ends."
+        entry = self._find(col - 1)
+        if entry is None:
+            return col
+        return entry[3] + col - entry[0] - 1
+
+    def offset(self, col):
+        "Offset of column col (or of the end of the line)."
+        entry = self._find(col)
+        if entry is None:
+            return col
+        if entry[0] == col:
+            return entry[2]
+        return entry[3] + col - entry[0] - 1
+
+    def column(self, cell):
+        "Last column whose offset is at most cell, or the line's end."
+        head, tail = self.head, self.tail
+        if tail[0] and self.end - tail[2][-1] <= cell:
+            j = bisect_left(tail[2], self.end - cell)
+            col, end = self.length - tail[0][j], self.end - tail[3][j]
+            nxt = self.length - tail[0][j - 1] - 1 if j else self.length
+        else:
+            k = bisect_right(head[2], cell) - 1
+            if k + 1 < len(head[0]):
+                nxt = head[0][k + 1] - 1
+            elif tail[0]:
+                nxt = self.length - tail[0][-1] - 1
+            else:
+                nxt = self.length
+            if k < 0:
+                return min(cell, nxt)
+            col, end = head[0][k], head[3][k]
+        if cell < end:
+            return col
+        return min(col + 1 + cell - end, nxt)
+
+    def replace(self, col, n, s):
+        """Update the offsets for n characters at col replaced by s.
+
+        The characters after the edit are placed again only until they
+        fall on the same x position as before; the rest keep their
+        offsets relative to the end of the line."""
+
+        self._move_gap(col)
+        head, tail, width = self.head, self.tail, self.width
+        d = self._end_before(col)
+        old_d = d + n
+        j = bisect_right(tail[0], self.length - col - n)
+        if j < len(tail[0]):
+            # entries of the replaced characters
+            c, end = self.length - tail[0][j], self.end - tail[3][j]
+            old_d = end + col + n - c - 1
+            for a in tail:
+                del a[j:]
+
+        prev = 0
+        for m in _MAYBE_WIDE.finditer(s):
+            i = m.start()
+            w = _char_width(s[i])
+            if w == 1:
+                continue
+            start, d = self._place(d + i - prev, w)
+            prev = i + 1
+            for a, v in zip(head, (col + i, w, start, d)):
+                a.append(v)
+        d += len(s) - prev
+
+        # place the characters after the edit again until they line up
+        # with the old rows (at the start of the line a zero-width
+        # character has no row to stay on, so it never lines up there)
+        shift = len(s) - n
+        last = col + n
+        cols, widths, starts, ends = tail
+        L, E = self.length, self.end
+        j = len(cols)
+        while j and ((d - old_d) % width or not d or not old_d):
+            j -= 1
+            c, w = L - cols[j], widths[j]
+            old_d = E - ends[j]
+            d += c - last
+            if w == 0:
+                start = d - 1 if d and d % width == 0 else d
+            else:
+                x = d % width
+                if x and x + w > width:
+                    d += width - x
+                start = d
+                d += min(w, width)
+            last = c + 1
+            head[0].append(c + shift)
+            head[1].append(w)
+            head[2].append(start)
+            head[3].append(d)
+        for a in tail:
+            del a[j:]
+        if j:
+            self.end += d - old_d
+        else:
+            self.end = d + self.length - last
+        self.length += shift
+
+
+class _Breaks(object):
+
+    """Rows of one line wrapped at word boundaries, for word_wrap mode.
+
+    `starts` holds the column at which each row starts.  A row ends
+    after the last space that fits in the window, or at the window edge
+    if its word does not fit on a row of its own; a row filled to the
+    edge is followed by an empty one for the cursor at the end of the
+    line, as with character wrapping.  Offsets (row * width + x) are
+    found with a bisection of `starts`; a copy of the text is kept only
+    for lines holding wide or zero-width characters.
+
+    After an edit the rows are wrapped again from the first one whose
+    end may depend on it, and only until a row starts where one did
+    before.
+    """
+
+    def __init__(self, width):
+        self.width = width
+        self.length = 0  # characters in the line
+        self.starts = array('i', [0])
+        self.last = 0  # cells taken by the last row
+        self.s = None  # the line, if it may hold wide characters
+
+    def __len__(self):
+        "Nonzero while the line needs this: it wraps or is wide."
+        return len(self.starts) - 1 + (self.s is not None)
+
+    @property
+    def end(self):
+        "Offset of the end of the line."
+        return (len(self.starts) - 1) * self.width + self.last
+
+    @classmethod
+    def measure(cls, s, width):
+        "Rows of the line s, or None if it fits on one row."
+        brk = cls(width)
+        brk.replace(0, 0, s, lambda a, b: s[a:b])
+        return brk if len(brk) else None
+
+    def _row_width(self, a, b):
+        "Cells taken by columns a..b-1, all on one row."
+        if self.s is None:
+            return b - a
+        return _text_width(self.s[a:b])
+
+    def _next_break(self, a, get):
+        """Column at which the row after the one starting at a starts,
+        or None if the row is the last one."""
+
+        width = self.width
+        t = get(a, a + 2 * width + 2)
+        if self.s is None:
+            i = min(width, len(t))
+            used = i
+        else:
+            i = used = 0
+            while i < len(t):
+                w = _char_width(t[i])
+                if used + w > width:
+                    break
+                used += w
+                i += 1
+        if a + i >= self.length:
+            # the rest fits
+            return self.length if used == width else None
+        if not i:
+            return a + 1  # a character wider than the window
+        if i < len(t) and t[i] == ' ':
+            # the space after a full row stays on it, past the edge
+            return a + i + 1
+        k = t.rfind(' ', 0, i)
+        return a + (k + 1 if k >= 0 else i)
+
+    def offset(self, col):
+        """Offset of column col (or of the end of the line).  A space
+        past the edge of a full row is shown on its last cell."""
+        r = bisect_right(self.starts, col) - 1
+        return r * self.width + min(self._row_width(self.starts[r], col),
+                                    self.width - 1)
+
+    def row_start(self, r):
+        "First column of row r, or past the end of the line."
+        return self.starts[r] if r < len(self.starts) else self.length + 1
+
+    def column(self, cell):
+        "Last column whose offset is at most cell, or the line's end."
+        starts = self.starts
+        r = cell // self.width
+        if r >= len(starts):
+            return self.length
+        a = starts[r]
+        e = starts[r + 1] - 1 if r + 1 < len(starts) else self.length
+        x = cell % self.width
+        if self.s is None:
+            return min(a + x, e)
+        used = 0
+        for i, ch in enumerate(self.s[a:e]):
+            used += _char_width(ch)
+            if used > x:
+                return a + i
+        return e
+
+    def replace(self, col, n, s, get):
+        """Update the rows for n characters at col replaced by s; get(a,
+        b) returns columns a..b-1 of the line after the edit."""
+
+        delta = len(s) - n
+        self.length += delta
+        # where a row ends depends on the characters _next_break looks
+        # at from its start, which may reach the edit from several rows
+        # back
+        back = self.width
+        if self.s is not None or _MAYBE_WIDE.search(s):
+            back = 2 * self.width + 2
+            self.s = get(0, None)
+            if not _MAYBE_WIDE.search(self.s):
+                self.s = None
+        if self.s is not None:
+            get = lambda a, b: self.s[a:b]
+        starts = self.starts
+        i = min(bisect_left(starts, col - back),
+                bisect_right(starts, col) - 1)
+        j = max(bisect_left(starts, col + n), i + 1)
+        new = starts[:i + 1]
+        a = starts[i]
+        while 1:
+            b = self._next_break(a, get)
+            if b is None:
+                self.last = self._row_width(a, self.length)
+                break
+            while j < len(starts) and starts[j] + delta < b:
+                j += 1
+            if j < len(starts) and starts[j] + delta == b:
+                # the rest wraps as before
+                new.extend(x + delta for x in starts[j:])
+                break
+            new.append(b)
+            a = b
+        self.starts = new
+
+
+_PENDING = object()
+
+
+class _LineCells(object):
+
+    """The _Cells or _Breaks of every line that needs them, in a list
+    with a slot per line, so that adding or removing lines splices the
+    list instead of renumbering the lines below.  A line flagged with
+    pend() is known to need them but has not been measured yet: it is
+    `in` the list while get() still returns None."""
+
+    def __init__(self, n):
+        self.slots = [None] * n
+
+    def get(self, line):
+        v = self.slots[line] if 0 <= line < len(self.slots) else None
+        return None if v is _PENDING else v
+
+    def __contains__(self, line):
+        return 0 <= line < len(self.slots) \
+            and self.slots[line] is not None
+
+    def __setitem__(self, line, cells):
+        self.slots[line] = cells
+
+    def __delitem__(self, line):
+        self.slots[line] = None
+
+    def pop(self, line, default=None):
+        cells = self.get(line)
+        if 0 <= line < len(self.slots):
+            self.slots[line] = None
+        return default if cells is None else cells
+
+    def pend(self, line):
+        self.slots[line] = _PENDING
+
+    def splice(self, line, last, k):
+        """Replace the slots of lines line..last with k empty ones and
+        return True if any of them was in use."""
+
+        dropped = any(v is not None for v in self.slots[line:last + 1])
+        self.slots[line:last + 1] = [None] * k
+        return dropped
+
+    def extend(self, k):
+        self.slots.extend([None] * k)
+
+
+class RopeBuffer(object):
+
+    """Text buffer backed by a balanced rope.
+
+    Lines are addressed by (line, column) pairs as in Textbox.vpos.
+    Inserting or deleting text costs O(log n) regardless of the length
+    of the line being edited.
+    """
+
+    complete = True  # the whole document is loaded
+
+    def __init__(self, text=''):
+        self.root = _rope_build(text)
+
+    def __len__(self):
+        "Number of lines."
+        return (self.root.newlines if self.root else 0) + 1
+
+    def __getitem__(self, i):
+        return self.get(i)
+
+    def __iter__(self):
+        return self.lines_from(0)
+
+    def lines_from(self, start, stop=None):
+        "Yield lines start to stop-1 without going through the earlier ones."
+
+        n = len(self) if stop is None else min(stop, len(self))
+        if start >= n:
+            return
+        parts = []
+        for leaf in _rope_leaves(self.root, self.offset(start)):
+            pieces = leaf.split('\n')
+            parts.append(pieces[0])
+            for piece in pieces[1:]:
+                yield ''.join(parts)
+                start += 1
+                if start == n:
+                    return
+                parts = [piece]
+        yield ''.join(parts)
+
+    def size(self):
+        "Number of characters, newlines included."
+        return self.root.length if self.root else 0
+
+    def offset(self, line, col=0):
+        "Character offset of the position (line, col)."
+
+        if line == 0 or self.root is None:
+            return col
+        node, off, i = self.root, 0, line
+        while node.text is None:
+            if node.left.newlines >= i:
+                node = node.left
+            else:
+                i -= node.left.newlines
+                off += node.left.length
+                node = node.right
+        pos = -1
+        for _ in range(i):
+            pos = node.text.index('\n', pos + 1)
+        return off + pos + 1 + col
+
+    def line_length(self, line):
+        start = self.offset(line)
+        if line + 1 < len(self):
+            return self.offset(line + 1) - 1 - start
+        return self.size() - start
+
+    def line_lengths(self, start=0):
+        "Yield the length of every line from start on."
+        if start >= len(self):
+            return
+        cur = 0
+        for leaf in _rope_leaves(self.root, self.offset(start)):
+            pieces = leaf.split('\n')
+            cur += len(pieces[0])
+            for piece in pieces[1:]:
+                yield cur
+                cur = len(piece)
+        yield cur
+
+    def wide_lines(self, start=0):
+        """Yield (line, text) for the lines from start on that may hold
+        characters other than single-cell ones."""
+
+        off = self.offset(start) if start < len(self) else self.size()
+        if not any(_MAYBE_WIDE.search(leaf)
+                   for leaf in _rope_leaves(self.root, off)):
+            return
+        for i, s in enumerate(self.lines_from(start), start):
+            if _MAYBE_WIDE.search(s):
+                yield i, s
+
+    def get(self, line, start=0, stop=None):
+        "Return line[start:stop] without building the whole line."
+
+        ll = self.line_length(line)
+        if stop is None or stop > ll:
+            stop = ll
+        if start >= stop:
+            return ''
+        base = self.offset(line)
+        return ''.join(_rope_leaves(self.root, base + start, base + stop))
+
+    def replace(self, line, col, n, s):
+        "Replace n characters at (line, col) with s; return the old text."
+
+        off = self.offset(line, col)
+        if self.root is None:
+            self.root = _rope_build(s)
+            return ''
+        n = min(n, self.root.length - off)
+        old = ''.join(_rope_leaves(self.root, off, off + n))
+        if len(s) <= _LEAF_SIZE:
+            root = _rope_patch(self.root, off, n, s)
+            if root is not None:
+                self.root = root
+                return old
+        left, rest = _rope_split(self.root, off)
+        rest = _rope_split(rest, n)[1]
+        self.root = _rope_concat(_rope_concat(left, _rope_build(s)), rest)
+        return old
+
+    def insert(self, line, col, s):
+        "Insert s (which may contain newlines) at (line, col)."
+        self.replace(line, col, 0, s)
+
+    def delete(self, line, col, n=1):
+        "Delete n characters at (line, col), newlines count as one."
+        return self.replace(line, col, n, '')
+
+    def chunks(self, size=1 << 16):
+        "Yield the text in blocks of about size characters."
+        return _coalesce(_rope_leaves(self.root), size)
+
+    def getvalue(self):
+        return ''.join(_rope_leaves(self.root))
+
+
+class ListBuffer(object):
+
+    """Text buffer backed by a plain list of lines.
+
+    This is the storage Textbox used originally.  It is cheap for short
+    lines but every edit rebuilds the whole line.
+    """
+
+    complete = True
+
+    def __init__(self, text=''):
+        self.lines = text.split('\n')
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self, i):
+        return self.lines[i]
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def lines_from(self, start, stop=None):
+        return iter(self.lines[start:stop])
+
+    def size(self):
+        return sum(len(l) for l in self.lines) + len(self.lines) - 1
+
+    def offset(self, line, col=0):
+        return sum(len(l) + 1 for l in self.lines[:line]) + col
+
+    def line_length(self, line):
+        return len(self.lines[line])
+
+    def line_lengths(self, start=0):
+        return (len(l) for l in self.lines[start:])
+
+    def wide_lines(self, start=0):
+        for i in range(start, len(self.lines)):
+            if _MAYBE_WIDE.search(self.lines[i]):
+                yield i, self.lines[i]
+
+    def get(self, line, start=0, stop=None):
+        return self.lines[line][start:stop]
+
+    def replace(self, line, col, n, s):
+        # gather the lines touched by the deletion
+        end = line
+        left = n - len(self.lines[line]) + col
+        while left > 0 and end + 1 < len(self.lines):
+            end += 1
+            left -= len(self.lines[end]) + 1
+        text = '\n'.join(self.lines[line:end + 1])
+        old = text[col:col + n]
+        self.lines[line:end + 1] = \
+            (text[:col] + s + text[col + n:]).split('\n')
+        return old
+
+    def insert(self, line, col, s):
+        self.replace(line, col, 0, s)
+
+    def delete(self, line, col, n=1):
+        return self.replace(line, col, n, '')
+
+    def chunks(self, size=1 << 16):
+        return _coalesce(_newline_joined(self.lines), size)
+
+    def getvalue(self):
+        return '\n'.join(self.lines)
+
+
+class _Fenwick(object):
+    "Fenwick (binary indexed) tree of integers."
+
+    def __init__(self, values):
+        self.n = len(values)
+        self.tree = tree = array('i', [0]) + array('i', values)
+        for i in range(1, self.n + 1):
+            j = i + (i & -i)
+            if j <= self.n:
+                tree[j] += tree[i]
+        self.total = sum(values)
+
+    def add(self, i, delta):
+        "Add delta to the i-th value."
+        self.total += delta
+        i += 1
+        while i <= self.n:
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix(self, i):
+        "Sum of the first i values."
+        s = 0
+        while i > 0:
+            s += self.tree[i]
+            i -= i & -i
+        return s
+
+    def search(self, target):
+        """Return (k, prefix(k)) for the largest k with prefix(k) <= target,
+        i.e. the index of the value that contains target."""
+        pos, rem = 0, target
+        step = 1 << self.n.bit_length()
+        while step:
+            nxt = pos + step
+            if nxt <= self.n and self.tree[nxt] <= rem:
+                pos = nxt
+                rem -= self.tree[nxt]
+            step >>= 1
+        return pos, target - rem
+
+
+class RowIndex(object):
+
+    """Number of wrapped (visual) rows of every logical line.
+
+    Behaves like the list of row counts Textbox.lcount used to be, but
+    counts are stored in blocks of array('i') with Fenwick trees over
+    the per-block sums, so the total and the mapping between logical
+    lines and visual rows cost O(log n) instead of O(number of lines).
+    """
+
+    BLOCK = 512
+
+    def __init__(self, counts=()):
+        self._reset(array('i', counts))
+
+    def _reset(self, counts):
+        B = self.BLOCK
+        self._blocks = [counts[i:i + B]
+                        for i in range(0, len(counts), B)] or [array('i')]
+        self._sums = [sum(b) for b in self._blocks]
+        self._rebuild()
+
+    def _rebuild(self):
+        self._lines = _Fenwick([len(b) for b in self._blocks])
+        self._rows = _Fenwick(self._sums)
+
+    def _locate(self, i):
+        "Block number and offset within the block of line i."
+        if i < 0:
+            i += self._lines.total
+        if not 0 <= i <= self._lines.total:
+            raise IndexError('line index out of range')
+        b, before = self._lines.search(i)
+        if b == len(self._blocks):
+            b -= 1
+            before -= len(self._blocks[b])
+        return b, i - before
+
+    def __len__(self):
+        return self._lines.total
+
+    def __iter__(self):
+        return chain.from_iterable(self._blocks)
+
+    def __getitem__(self, i):
+        b, j = self._locate(i)
+        return self._blocks[b][j]
+
+    def __setitem__(self, i, count):
+        b, j = self._locate(i)
+        block = self._blocks[b]
+        self._sums[b] += count - block[j]
+        self._rows.add(b, count - block[j])
+        block[j] = count
+
+    def insert(self, i, count):
+        b, j = self._locate(i)
+        block = self._blocks[b]
+        block.insert(j, count)
+        self._sums[b] += count
+        if len(block) > 2 * self.BLOCK:
+            halves = [block[:self.BLOCK], block[self.BLOCK:]]
+            self._blocks[b:b + 1] = halves
+            self._sums[b:b + 1] = [sum(h) for h in halves]
+            self._rebuild()
+        else:
+            self._lines.add(b, 1)
+            self._rows.add(b, count)
+
+    def append(self, count):
+        self.insert(len(self), count)
+
+    def pop(self, i=-1):
+        b, j = self._locate(i)
+        block = self._blocks[b]
+        count = block.pop(j)
+        self._sums[b] -= count
+        if not block and len(self._blocks) > 1:
+            del self._blocks[b]
+            del self._sums[b]
+            self._rebuild()
+        else:
+            self._lines.add(b, -1)
+            self._rows.add(b, -count)
+        return count
+
+    def splice(self, i, j, counts):
+        "Replace the counts of lines i to j-1 with counts."
+
+        counts = array('i', counts)
+        if max(len(counts), j - i) > self.BLOCK:
+            # re-block just the blocks covering the splice, in one
+            # pass rather than line by line
+            b1, j1 = self._locate(i)
+            b2, j2 = self._locate(j)
+            flat = self._blocks[b1][:j1] + counts + self._blocks[b2][j2:]
+            B = self.BLOCK
+            blocks = [flat[k:k + B] for k in range(0, len(flat), B)]
+            if not blocks and b2 - b1 + 1 == len(self._blocks):
+                blocks = [array('i')]
+            self._blocks[b1:b2 + 1] = blocks
+            self._sums[b1:b2 + 1] = [sum(b) for b in blocks]
+            self._rebuild()
+            return
+        for k in range(min(len(counts), j - i)):
+            self[i + k] = counts[k]
+        for k in range(j - i, len(counts)):
+            self.insert(i + k, counts[k])
+        for k in range(len(counts), j - i):
+            self.pop(i + len(counts))
+
+    def total(self):
+        "Total number of visual rows."
+        return self._rows.total
+
+    def rows_before(self, i):
+        "Visual row at which logical line i starts."
+        b, j = self._locate(i)
+        return self._rows.prefix(b) + sum(self._blocks[b][:j])
+
+    def line_at(self, row):
+        """Logical line shown at visual row `row`, and the row offset
+        within that line.  Rows past the end map to len(self)."""
+        b, before = self._rows.search(row)
+        if b == len(self._blocks):
+            return len(self), row - before
+        block = self._blocks[b]
+        j = bisect_right(list(accumulate(block)), row - before)
+        return (self._lines.prefix(b) + j,
+                row - before - sum(block[:j]))
+
+
+class MappedBuffer(object):
+
+    """Text buffer over a memory-mapped file.
+
+    Only a line-offset index is kept for the file: lines are decoded
+    when they are asked for, and a small cache holds the ones near the
+    viewport.  The index is built a chunk at a time with index_more();
+    until `complete` is set the buffer only shows the lines indexed so
+    far.  Edited lines are kept as strings in a line-level piece table
+    on top of the mapped lines, so the file itself is never modified.
+    """
+
+    CHUNK = 1 << 20  # bytes indexed by each index_more call
+    CACHE = 256  # decoded lines kept around
+
+    def __init__(self, path, encoding='utf-8'):
+        self.path = path
+        self.encoding = encoding
+        with open(path, 'rb') as f:
+            try:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty files cannot be mapped
+                self._data = b''
+        self.complete = False
+        self._scanned = 0  # bytes indexed so far
+        self._starts = array('q', [0])  # byte offset of each mapped line
+        self._lengths = array('i')  # character length of each mapped line
+        self._cache = {}
+        # pieces are ranges of mapped line numbers or lists of edited
+        # lines; _ends holds the cumulative number of lines
+        self._pieces = []
+        self._ends = []
+        self.index_more()
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+
+    def index_more(self, nbytes=None):
+        """Index about nbytes more of the file and return the lengths of
+        the lines that were added."""
+
+        if self.complete:
+            return []
+        data, pos = self._data, self._scanned
+        end = min(pos + (nbytes or self.CHUNK), len(data))
+        nl = data.rfind(b'\n', pos, end)
+        if nl < 0 and end < len(data):
+            nl = data.find(b'\n', end)
+        last = nl < 0
+        stop = len(data) if last else nl + 1
+        chunk = data[pos:stop]
+        parts = chunk.split(b'\n')
+        if not last:
+            parts.pop()  # nothing follows the final newline yet
+
+        # every line is followed by a newline, real or not
+        self._starts[-1:] = array('q', accumulate(
+            chain([pos], map((1).__add__, map(len, parts)))))
+        try:
+            ascii_only = chunk.isascii()
+        except AttributeError:
+            ascii_only = False
+        if ascii_only:
+            self._lengths.extend(map(len, parts))
+        else:
+            self._lengths.extend(len(p.decode(self.encoding, 'replace'))
+                                 for p in parts)
+        self._scanned = stop
+        self.complete = last
+
+        first, added = len(self._lengths) - len(parts), len(parts)
+        if self._pieces and isinstance(self._pieces[-1], range) \
+           and self._pieces[-1].stop == first:
+            self._pieces[-1] = range(self._pieces[-1].start, first + added)
+            self._ends[-1] += added
+        else:
+            self._pieces.append(range(first, first + added))
+            self._ends.append(len(self) + added)
+        return self._lengths[first:]
+
+    def _mapped_line(self, k):
+        "Decode line k of the file."
+        s = self._cache.get(k)
+        if s is None:
+            if len(self._cache) >= self.CACHE:
+                self._cache.clear()
+            s = self._cache[k] = self._data[
+                self._starts[k]:self._starts[k + 1] - 1].decode(
+                    self.encoding, 'replace')
+        return s
+
+    def _find(self, line):
+        "Piece number holding line and the line's offset in it."
+        if not 0 <= line < len(self):
+            raise IndexError('line index out of range')
+        p = bisect_right(self._ends, line)
+        return p, line - (self._ends[p - 1] if p else 0)
+
+    def _split_at(self, line):
+        "Make line start a piece and return that piece's number."
+        if line == len(self):
+            return len(self._pieces)
+        p, j = self._find(line)
+        if j:
+            piece = self._pieces[p]
+            self._pieces[p:p + 1] = [piece[:j], piece[j:]]
+            self._ends.insert(p, line)
+            p += 1
+        return p
+
+    def _set_lines(self, i, j, lines):
+        "Replace lines i to j-1 with the strings in lines."
+
+        p, k = self._find(i)
+        piece = self._pieces[p]
+        if isinstance(piece, list) and k + j - i <= len(piece):
+            # within one piece of edited lines
+            piece[k:k + j - i] = lines
+        else:
+            p = self._split_at(i)
+            q = self._split_at(j)
+            self._pieces[p:q] = [list(lines)]
+            # merge small neighbouring edits to keep the table short
+            for a in (p, p - 1):
+                if 0 <= a < len(self._pieces) - 1 \
+                   and isinstance(self._pieces[a], list) \
+                   and isinstance(self._pieces[a + 1], list) \
+                   and len(self._pieces[a]) + len(self._pieces[a + 1]) < 4096:
+                    self._pieces[a:a + 2] = [self._pieces[a]
+                                             + self._pieces[a + 1]]
+        self._pieces = [piece for piece in self._pieces if len(piece)]
+        self._ends = list(accumulate(len(piece) for piece in self._pieces))
+
+    def __len__(self):
+        "Number of lines indexed so far."
+        return self._ends[-1] if self._ends else 0
+
+    def __getitem__(self, i):
+        return self.get(i)
+
+    def __iter__(self):
+        return self.lines_from(0)
+
+    def lines_from(self, start, stop=None):
+        "Yield lines start to stop-1 without going through the earlier ones."
+
+        n = len(self) if stop is None else min(stop, len(self))
+        if start >= n:
+            return
+        p, j = self._find(start)
+        for piece in self._pieces[p:]:
+            if isinstance(piece, list):
+                for line in piece[j:j + n - start]:
+                    yield line
+            else:
+                # decode a bounded number of lines at a time
+                last = min(piece.stop, piece.start + j + n - start)
+                for k in range(piece.start + j, last, 4096):
+                    a = self._starts[k]
+                    b = self._starts[min(k + 4096, last)] - 1
+                    for line in self._data[a:b].decode(
+                            self.encoding, 'replace').split('\n'):
+                        yield line
+            start += len(piece) - j
+            if start >= n:
+                return
+            j = 0
+
+    def size(self):
+        "Number of characters in the indexed lines, newlines included."
+        return sum(self.line_lengths()) + len(self) - 1
+
+    def offset(self, line, col=0):
+        return sum(self.line_length(i) + 1 for i in range(line)) + col
+
+    def line_length(self, line):
+        p, j = self._find(line)
+        piece = self._pieces[p]
+        if isinstance(piece, list):
+            return len(piece[j])
+        return self._lengths[piece[j]]
+
+    def line_lengths(self, start=0):
+        if start >= len(self):
+            return
+        p, j = self._find(start)
+        for piece in self._pieces[p:]:
+            if isinstance(piece, list):
+                for line in piece[j:]:
+                    yield len(line)
+            else:
+                for l in self._lengths[piece.start + j:piece.stop]:
+                    yield l
+            j = 0
+
+    def wide_lines(self, start=0):
+        line = 0
+        for piece in self._pieces:
+            end = line + len(piece)
+            if end <= start:
+                line = end
+                continue
+            if isinstance(piece, list):
+                for j in range(max(start - line, 0), len(piece)):
+                    if _MAYBE_WIDE.search(piece[j]):
+                        yield line + j, piece[j]
+            else:
+                for a in range(max(start - line, 0), len(piece), 4096):
+                    b = min(a + 4096, len(piece))
+                    ks, ke = piece[a], piece[b - 1] + 1
+                    # skip blocks holding single-byte characters only
+                    if self._starts[ke] - self._starts[ks] - (ke - ks) \
+                       == sum(self._lengths[ks:ke]):
+                        continue
+                    for k in range(ks, ke):
+                        if self._starts[k + 1] - 1 - self._starts[k] \
+                           == self._lengths[k]:
+                            continue
+                        s = self._data[self._starts[k]:
+                                       self._starts[k + 1] - 1].decode(
+                                           self.encoding, 'replace')
+                        if _MAYBE_WIDE.search(s):
+                            yield line + k - piece.start, s
+            line = end
+
+    def get(self, line, start=0, stop=None):
+        p, j = self._find(line)
+        piece = self._pieces[p]
+        if isinstance(piece, list):
+            return piece[j][start:stop]
+        k = piece[j]
+        base = self._starts[k]
+        nbytes = self._starts[k + 1] - 1 - base
+        if nbytes == self._lengths[k]:
+            # single-byte characters only: slice without decoding
+            if stop is None or stop > nbytes:
+                stop = nbytes
+            return self._data[base + start:base + max(start, stop)].decode(
+                self.encoding, 'replace')
+        return self._mapped_line(k)[start:stop]
+
+    def replace(self, line, col, n, s):
+        # gather the lines touched by the deletion, joined once
+        lines = []
+        left = col + n
+        for text in self.lines_from(line):
+            lines.append(text)
+            left -= len(text)
+            if left <= 0:
+                break
+            left -= 1  # the newline
+        text = '\n'.join(lines)
+        old = text[col:col + n]
+        self._set_lines(line, line + len(lines),
+                        (text[:col] + s + text[col + n:]).split('\n'))
+        return old
+
+    def insert(self, line, col, s):
+        self.replace(line, col, 0, s)
+
+    def delete(self, line, col, n=1):
+        return self.replace(line, col, n, '')
+
+    def _groups(self, size):
+        "Yield the indexed text as strings of whole lines."
+
+        for piece in self._pieces:
+            if isinstance(piece, list):
+                for line in piece:
+                    yield line
+                continue
+            k = piece.start
+            while k < piece.stop:
+                # as many lines as fit in size bytes, at least one
+                end = bisect_right(self._starts, self._starts[k] + size,
+                                   k + 1, piece.stop + 1) - 1
+                end = min(max(end, k + 1), piece.stop)
+                yield self._data[self._starts[k]:
+                                 self._starts[end] - 1].decode(
+                                     self.encoding, 'replace')
+                k = end
+
+    def chunks(self, size=1 << 16):
+        """Yield the text in blocks of about size characters, the part
+        of the file not indexed yet included."""
+
+        for block in _coalesce(_newline_joined(self._groups(size)), size):
+            yield block
+        if not self.complete:
+            yield '\n'
+            decoder = codecs.getincrementaldecoder(self.encoding)('replace')
+            for k in range(self._scanned, len(self._data), size):
+                yield decoder.decode(self._data[k:k + size])
+            yield decoder.decode(b'', True)
+
+    def getvalue(self):
+        return ''.join(self.chunks())
+
+
+def _end_of(line, col, s):
+    "Position right after s when it is inserted at (line, col)."
+    k = s.count('\n')
+    if k:
+        return line + k, len(s) - s.rfind('\n') - 1
+    return line, col + len(s)
+
+
+def _moved(pos, line, col, old, s):
+    """Where the position pos ends up when old at (line, col) is
+    replaced by s.  Positions within old move to its start."""
+    if pos <= (line, col):
+        return pos
+    end = _end_of(line, col, old)
+    if pos < end:
+        return (line, col)
+    new_end = _end_of(line, col, s)
+    if pos[0] == end[0]:
+        return (new_end[0], new_end[1] + pos[1] - end[1])
+    return (pos[0] + new_end[0] - end[0], pos[1])
+
+
+class UndoJournal(object):
+
+    """Undo and redo stacks of compact edit records.
+
+    A record (line, col, removed, inserted) says that `removed` at
+    (line, col) was replaced by `inserted`.  An insertion that starts
+    where the previous one ended is merged into it until seal() is
+    called, so a run of typing is undone at once.  When the records
+    hold more than `limit` characters the oldest ones are dropped, but
+    never the newest, so the last edit can be undone however large.
+    """
+
+    MERGE = 256  # longest run of typing merged into one record
+
+    def __init__(self, limit=1 << 22):
+        self.limit = limit
+        self.undos = deque()
+        self.redos = []
+        self.size = 0
+        self.sealed = True
+
+    @staticmethod
+    def _cost(rec):
+        return len(rec[2]) + len(rec[3]) + 1
+
+    def seal(self):
+        "Start a new record with the next edit."
+        self.sealed = True
+
+    def record(self, line, col, removed, inserted):
+        self.size -= sum(self._cost(rec) for rec in self.redos)
+        self.redos = []
+        last = self.undos[-1] if self.undos else None
+        if not self.sealed and not removed and last is not None \
+           and not last[2] and len(last[3]) < self.MERGE \
+           and _end_of(*last[:2] + (last[3],)) == (line, col):
+            rec = (last[0], last[1], '', last[3] + inserted)
+            self.undos[-1] = rec
+            self.size += len(inserted)
+        else:
+            rec = (line, col, removed, inserted)
+            self.undos.append(rec)
+            self.size += self._cost(rec)
+        self.sealed = False
+        # the newest record is kept even if it is over the limit alone
+        while self.size > self.limit and len(self.undos) > 1:
+            self.size -= self._cost(self.undos.popleft())
+
+    def pop_undo(self):
+        "Move the last record to the redo stack and return it."
+        if not self.undos:
+            return None
+        self.sealed = True
+        rec = self.undos.pop()
+        self.redos.append(rec)
+        return rec
+
+    def pop_redo(self):
+        "Move the last undone record back and return it."
+        if not self.redos:
+            return None
+        self.sealed = True
+        rec = self.redos.pop()
+        self.undos.append(rec)
+        return rec
+
+    def drop_lines(self, k):
+        """Follow the removal of the first k lines of the text.
+
+        Later records are renumbered.  A record starting in the removed
+        lines can no longer be applied, nor can the ones that would have
+        to be undone (or redone) after it, so they are all dropped."""
+
+        self.sealed = True
+        kept = []
+        for stack in (self.undos, self.redos):
+            recs = []
+            for rec in reversed(stack):
+                if rec[0] < k:
+                    break
+                recs.append((rec[0] - k,) + rec[1:])
+            recs.reverse()
+            kept.append(recs)
+        self.undos = deque(kept[0])
+        self.redos = kept[1]
+        self.size = sum(self._cost(rec) for rec in chain(*kept))
+
+
+class KillRing(object):
+
+    """The most recent `limit` pieces of killed or copied text.
+
+    yank() returns the newest one; rotate() steps back to an older one
+    for Meta-y, wrapping around after the oldest."""
+
+    def __init__(self, limit=60):
+        self.kills = deque(maxlen=limit)
+        self.index = 0  # the entry yank returns, counted from the newest
+
+    def push(self, s):
+        "Add s as the newest entry, dropping the oldest if full."
+        self.kills.append(s)
+        self.index = 0
+
+    def yank(self):
+        "The entry to insert, or None if the ring is empty."
+        if not self.kills:
+            return None
+        return self.kills[-1 - self.index]
+
+    def rotate(self):
+        "Step back to the next older entry and return it."
+        if not self.kills:
+            return None
+        self.index = (self.index + 1) % len(self.kills)
+        return self.yank()
+
+
+class LineMap(object):
+
+    """A transform for Textbox.transform: func applied to every line.
+
+    Transforms run map on chunks of consecutive lines, on a thread or
+    process pool, then combine the chunks' results, in order, into the
+    new lines.  Subclasses override both.  To run on a process pool
+    the transform must pickle, so func should be a module-level
+    function or a builtin such as str.upper."""
+
+    def __init__(self, func):
+        self.func = func
+
+    def map(self, lines):
+        return [self.func(s) for s in lines]
+
+    def combine(self, results):
+        return chain.from_iterable(results)
+
+
+class SortLines(LineMap):
+
+    "Sort the lines: each chunk is sorted, then the chunks are merged."
+
+    def __init__(self, key=None, reverse=False):
+        self.key = key
+        self.reverse = reverse
+
+    def map(self, lines):
+        return sorted(lines, key=self.key, reverse=self.reverse)
+
+    def combine(self, results):
+        return heapq.merge(*results, key=self.key, reverse=self.reverse)
+
+
+class UniqueLines(LineMap):
+
+    "Drop the lines equal to an earlier one, keeping the order."
+
+    def __init__(self):
+        pass
+
+    def map(self, lines):
+        return list(dict.fromkeys(lines))
+
+    def combine(self, results):
+        return dict.fromkeys(chain.from_iterable(results))
+
+
+class Reindent(LineMap):
+
+    """Indent by `new` columns per level instead of `old`.  Tabs in the
+    indentation are expanded to tabsize first; columns left over after
+    the last full level are kept."""
+
+    def __init__(self, old, new, tabsize=8):
+        self.old = old
+        self.new = new
+        self.tabsize = tabsize
+
+    def map(self, lines):
+        out = []
+        for s in lines:
+            t = s.lstrip(' \t')
+            if len(t) < len(s):
+                k = len(s[:len(s) - len(t)].expandtabs(self.tabsize))
+                (level, rest) = divmod(k, self.old)
+                s = ' ' * (level * self.new + rest) + t
+            out.append(s)
+        return out
+
+
+def _count_lines(lines):
+    "(lines, words, characters and newlines) in a chunk, for stats."
+    return (len(lines), sum(len(s.split()) for s in lines),
+            sum(len(s) for s in lines) + len(lines))
+
+
+# search matches are kept packed as line << 32 | col in an array('q'),
+# which sorts like the (line, col) pairs and takes a fraction of the
+# memory of a list of tuples
+def _packed(line, col):
+    return line << 32 | col
+
+
+def _unpacked(p):
+    return (p >> 32, p & 0xffffffff)
+
+
+# a line fetched on its own costs about as much as scanning this many
+# lines of a typical text
+_FETCH_COST = 256
+
+
+def _find_all(buf, query, size=1 << 16):
+    """Packed positions of every occurrence of query in buf, overlapping
+    ones included, found by scanning its chunks in order.  Only lines
+    already indexed by buf are searched; a search in progress adds the
+    matches of lines indexed later (see _Search.lines_added)."""
+
+    found = array('q')
+    nlines = len(buf)
+    keep = len(query) - 1  # tail of a chunk that may start a match
+    line, linestart = 0, 0  # current line and its offset in the text
+    carry, start = '', 0  # unsearched tail and its offset
+    for chunk in buf.chunks(size):
+        s = carry + chunk
+        counted = 0  # newlines in s[:counted] are accounted for
+        i = s.find(query)
+        while i >= 0:
+            n = s.count('\n', counted, i)
+            if n:
+                line += n
+                linestart = start + s.rfind('\n', counted, i) + 1
+            counted = i
+            if line >= nlines:
+                return found
+            found.append(line << 32 | start + i - linestart)
+            i = s.find(query, i + 1)
+        cut = max(len(s) - keep, counted)
+        n = s.count('\n', counted, cut)
+        if n:
+            line += n
+            linestart = start + s.rfind('\n', counted, cut) + 1
+        if line >= nlines:
+            break
+        carry, start = s[cut:], start + cut
+    return found
+
+
+def _find_from(buf, query, first):
+    """Packed positions of every occurrence of query in the lines of buf
+    from first on, overlapping ones included."""
+
+    found = array('q')
+    for line, s in enumerate(buf.lines_from(first), first):
+        i = s.find(query)
+        while i >= 0:
+            found.append(line << 32 | i)
+            i = s.find(query, i + 1)
+    return found
+
+
+def _narrow(buf, matches, query):
+    """The packed positions in matches, those of a prefix of query,
+    where query itself occurs.  Each line holding a match is fetched
+    once; when that would cost more than a scan, buf is searched for
+    query again instead."""
+
+    budget = len(buf) // _FETCH_COST
+    last = -1
+    for p in matches:
+        if p >> 32 != last:
+            last = p >> 32
+            budget -= 1
+            if budget < 0:
+                return _find_all(buf, query)
+    found = array('q')
+    last, s = -1, ''
+    for p in matches:
+        (line, col) = _unpacked(p)
+        if line != last:
+            last, s = line, buf.get(line)
+        if s.startswith(query, col):
+            found.append(p)
+    return found
+
+
+class _Search(object):
+
+    """State of an incremental search.
+
+    `matches` holds the sorted positions of `query`, packed (see
+    _packed), and `current` the one the cursor is on, or None.  `stack`
+    keeps the earlier states so that deleting a character or a step
+    goes back without searching again."""
+
+    def __init__(self, origin, vptl, forward):
+        self.origin = origin  # cursor and window position to go back to
+        self.vptl = vptl
+        self.forward = forward
+        self.query = ''
+        self.matches = array('q')
+        self.current = None
+        self.failing = False
+        self.stack = []
+
+    def save(self):
+        self.stack.append((self.query, self.matches, self.current,
+                           self.forward, self.failing))
+
+    def restore(self):
+        (self.query, self.matches, self.current,
+         self.forward, self.failing) = self.stack.pop()
+
+    def lines_added(self, buf, first):
+        """Add the matches in the lines of buf from first on, just
+        indexed, to the current and the saved states."""
+
+        done = set()
+        for state in [(self.query, self.matches)] + self.stack:
+            (query, matches) = state[:2]
+            # a step keeps the matches array of the state before it
+            if query and id(matches) not in done:
+                done.add(id(matches))
+                matches.extend(_find_from(buf, query, first))
+
+    def pick(self, strict, wrap=False):
+        """Index of the first match from the current one (or the origin)
+        in the search direction; None if there is none.  With strict the
+        current match itself is skipped, with wrap the search starts
+        over from the other end."""
+
+        m = self.matches
+        if wrap:
+            return (0 if self.forward else len(m) - 1) if m else None
+        pos = _packed(*(self.current or self.origin))
+        if self.forward:
+            i = bisect_right(m, pos) if strict else bisect_left(m, pos)
+            return i if i < len(m) else None
+        if strict or self.current is None:
+            i = bisect_left(m, pos) - 1
+        else:
+            i = bisect_right(m, pos) - 1
+        return i if i >= 0 else None
+
+
+class _Replace(object):
+
+    """State of a query-replace: the query, compiled as `pattern`, the
+    replacement, where to stop and the match the cursor is on, as
+    (line, col, m)."""
+
+    def __init__(self, query, replacement, regex, end):
+        self.query = query
+        self.pattern = re.compile(query if regex else re.escape(query))
+        self.replacement = replacement
+        self.regex = regex
+        self.end = end  # stop before this position; None for the end
+        self.current = None
+        self.count = 0
+
+    def expand(self, m):
+        "Text replacing the match m."
+        return m.expand(self.replacement) if self.regex else self.replacement
+
+
+# lexer state cached for lines not lexed since they last changed
+_STALE = object()
+
+
+class RegexHighlighter(object):
+
+    """Syntax highlighter colouring regular expression matches.
+
+    `rules` is a list of (pattern, attr) pairs; where several patterns
+    match, the one starting first, then the one listed first, wins.
+    `blocks` lists (start, end, attr) triples for constructs that may
+    span lines, such as block comments or multi-line strings.
+
+    Any object with an `initial` state and a lex(state, line) method
+    returning ([(start, stop, attr), ...], state) can be passed to
+    Textbox as its highlighter.  States must compare equal when lexing
+    would continue the same way; here the state is the number of the
+    open block or None.
+    """
+
+    initial = None
+
+    def __init__(self, rules=(), blocks=()):
+        self.attrs = {}
+        self.ends = []
+        groups = []
+        for k, (start, end, attr) in enumerate(blocks):
+            groups.append('(?P<b%d>%s)' % (k, start))
+            self.ends.append((re.compile(end), attr))
+        for k, (pattern, attr) in enumerate(rules):
+            groups.append('(?P<r%d>%s)' % (k, pattern))
+            self.attrs['r%d' % k] = attr
+        self.pattern = re.compile('|'.join(groups) or '(?!)')
+
+    def lex(self, state, line):
+        spans = []
+        pos = begin = 0
+        while 1:
+            if state is not None:
+                # inside a block: find where it ends
+                end, attr = self.ends[state]
+                m = end.search(line, pos)
+                if m is None:
+                    spans.append((begin, len(line), attr))
+                    return spans, state
+                spans.append((begin, m.end(), attr))
+                pos, state = m.end(), None
+            m = self.pattern.search(line, pos)
+            if m is None:
+                return spans, None
+            name = m.lastgroup
+            if name[0] == 'b':
+                state = int(name[1:])
+                begin, pos = m.start(), m.end()
+            else:
+                spans.append((m.start(), m.end(), self.attrs[name]))
+                pos = max(m.end(), m.start() + 1)
+
+
+class Document(object):
+
+    """Text shared by one or more Textbox views.
+
+    Holds the buffer and the undo history.  Every edit, made through
+    any view, goes through replace(), which passes it on to all the
+    views so each can update its own row index and repaint the rows it
+    shows.  Views are held by weak references.
+
+    With a RecoveryJournal as `journal` every edit is also logged to
+    disk, so the text can be rebuilt after a crash.
+    """
+
+    def __init__(self, text='', buffer_class=RopeBuffer, buffer=None,
+                 undo_limit=1 << 22, journal=None):
+        # document storage: see RopeBuffer/ListBuffer for the interface
+        self.text = buffer if buffer is not None else buffer_class(text)
+        # undo/redo records, holding at most undo_limit characters
+        self.history = UndoJournal(undo_limit)
+        self.views = weakref.WeakSet()
+        self.journal = journal
+
+    @classmethod
+    def from_file(cls, path, encoding='utf-8', **kwargs):
+        "Document over the memory-mapped file at path (see MappedBuffer)."
+        return cls(buffer=MappedBuffer(path, encoding), **kwargs)
+
+    def replace(self, line, col, n, s, record=True, source=None):
+        """Replace n characters at (line, col) with s, tell the views and
+        return the replaced text.  source is the view making the edit,
+        which moves its cursor itself."""
+
+        views = list(self.views)
+        begun = [view._edit_begin(line, col) for view in views]
+        old = self.text.replace(line, col, n, s)
+        if record:
+            self.history.record(line, col, old, s)
+        if self.journal is not None:
+            self.journal.record(line, col, len(old), s)
+        for view, b in zip(views, begun):
+            view._edit_end(line, col, old, s, b, view is source)
+        return old
+
+    def load_more(self):
+        "Index more of a partially loaded buffer and tell the views."
+
+        first = len(self.text)
+        lengths = self.text.index_more()
+        if lengths:
+            for view in list(self.views):
+                view._lines_added(first, lengths)
+        return lengths
+
+
+class RecoveryJournal(object):
+
+    """Append-only log of the edits of a Document, for crash recovery.
+
+    Each edit is one JSON line [line, col, n, s]: n characters at
+    (line, col) were replaced by s.  record() only queues the edit; a
+    background thread writes the queue out in batches and fsyncs the
+    file at most every `interval` seconds, so typing never waits for
+    the disk.  Replay the file over the original text with
+    Textbox.recover, and close(remove=True) once the text is saved.
+    """
+
+    def __init__(self, path, interval=1.0):
+        self.path = path
+        self.interval = interval
+        self.error = None  # exception that stopped the writer, if any
+        self._queue = queue.Queue()
+        self._file = codecs.open(path, 'a', 'utf-8')
+        self._thread = threading.Thread(target=self._write,
+                                        name='texteditpad-journal')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def record(self, line, col, n, s):
+        "Queue the replacement of n characters at (line, col) by s."
+        self._queue.put((line, col, n, s))
+
+    def _write(self):
+        f = self._file
+        synced = _clock()
+        dirty = False
+        try:
+            while 1:
+                try:
+                    rec = self._queue.get(timeout=self.interval)
+                except queue.Empty:
+                    rec = ()  # idle: just sync what was written
+                batch = [rec]
+                while rec is not None:
+                    try:
+                        rec = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    batch.append(rec)
+                f.write(''.join(json.dumps(r) + '\n' for r in batch if r))
+                dirty = dirty or any(batch)
+                if dirty and (batch[-1] is None
+                              or _clock() - synced >= self.interval):
+                    f.flush()
+                    os.fsync(f.fileno())
+                    synced = _clock()
+                    dirty = False
+                if batch[-1] is None:
+                    return
+        except Exception as e:
+            self.error = e
+
+    def close(self, remove=False):
+        """Write out and sync the queued edits and stop the writer;
+        with remove, delete the journal afterwards."""
+
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+        if remove:
+            os.remove(self.path)
+
+    @staticmethod
+    def replay(path, document):
+        """Apply the edits logged at path to document, which must hold
+        the text the journal was started with.  A record cut short by
+        the crash is ignored.  Returns the number of edits applied."""
+
+        text = document.text
+        k = 0
+        with codecs.open(path, 'r', 'utf-8') as f:
+            for entry in f:
+                try:
+                    (line, col, n, s) = json.loads(entry)
+                except ValueError:
+                    break
+                # the edit may reach lines not indexed yet
+                while not text.complete and len(text) <= line + n + 1:
+                    if not document.load_more():
+                        break
+                document.replace(line, col, n, s)
+                k += 1
+        return k
+
+
+# xterm bracketed paste mode
+_PASTE_ON = '\x1b[?2004h'
+_PASTE_OFF = '\x1b[?2004l'
+_PASTE_START = tuple(ord(c) for c in '\x1b[200~')
+_PASTE_END = tuple(ord(c) for c in '\x1b[201~')
+
+
+def _partial_marker(keys):
+    """Length of the beginning of a paste marker that keys end with, or
+    0 if they do not."""
+    for n in range(2, len(_PASTE_START)):
+        tail = tuple(keys[-n:])
+        if tail in (_PASTE_START[:n], _PASTE_END[:n]):
+            return n
+    return 0
+
+
+def _printable(ch):
+    """True for keys that insert themselves: printable ASCII codes and
+    the non-ASCII characters returned by get_wch."""
+    if isinstance(ch, int):
+        return curses.ascii.isprint(ch)
+    return ord(ch) >= 0xa0
+
+
+def _as_key(ch):
+    "Key for the character ch: its code if ASCII, else ch itself."
+    return ord(ch) if ord(ch) < 0x80 else ch
+
+
+def _key_text(ch):
+    "Character inserted by the printable key ch."
+    return chr(ch) if isinstance(ch, int) else ch
+
+
+# names of the curses KEY_* codes, for Metrics
+_KEY_NAMES = dict((getattr(curses, name), name) for name in dir(curses)
+                  if name.startswith('KEY_') and name != 'KEY_MIN')
+
+
+def _command_name(ch):
+    "Name a command by its key, e.g. '^A' or 'KEY_UP'."
+    if _printable(ch):
+        return 'insert'
+    if isinstance(ch, int) and curses.ascii.isascii(ch):
+        return curses.ascii.unctrl(ch)
+    return _KEY_NAMES.get(ch, repr(ch))
+
+
+class Metrics(object):
+
+    """Opt-in performance counters for one or more Textbox views.
+
+    Pass an instance as Textbox(metrics=...).  Nothing is shown on the
+    screen; read the numbers with snapshot() or, with `path`, have them
+    written there as JSON when the interpreter exits.
+
+    `latency` maps command names (see _command_name; a run of inserted
+    text is 'insert_text', the repaint after a batch of keys 'render')
+    to histograms: bucket i counts the calls taking less than 2**i
+    microseconds (and at least half that).  `calls` counts the curses
+    window calls and `errors` the curses errors the views swallowed.
+    `repaints` maps numbers of rows to how many renders repainted that
+    many; `keys` and `rows` are the totals.
+    """
+
+    BUCKETS = 24  # the last bucket holds everything over 2**22 us
+
+    def __init__(self, path=None):
+        self.latency = {}
+        self.calls = {}
+        self.errors = 0
+        self.repaints = {}
+        self.keys = 0
+        self.rows = 0
+        self.views = weakref.WeakSet()
+        self.path = path
+        if path is not None:
+            atexit.register(self.dump, path)
+
+    def time(self, name, seconds):
+        "Add one call of command name that took seconds."
+        hist = self.latency.get(name)
+        if hist is None:
+            hist = self.latency[name] = [0] * self.BUCKETS
+        us = int(seconds * 1e6)
+        hist[min(us.bit_length(), self.BUCKETS - 1)] += 1
+
+    def repainted(self, rows):
+        "Count one render repainting rows rows."
+        self.rows += rows
+        self.repaints[rows] = self.repaints.get(rows, 0) + 1
+
+    def percentile(self, name, p):
+        """Upper bound in microseconds of the p-th percentile latency of
+        command name, or None if it never ran."""
+        hist = self.latency.get(name)
+        if not hist:
+            return None
+        k = p / 100 * sum(hist)
+        seen = 0
+        for i, n in enumerate(hist):
+            seen += n
+            if n and seen >= k:
+                return 1 << i
+        return 1 << (self.BUCKETS - 1)
+
+    def reset(self):
+        "Clear every counter."
+        self.latency.clear()
+        self.calls.clear()
+        self.repaints.clear()
+        self.errors = self.keys = self.rows = 0
+
+    def snapshot(self):
+        """The counters as a dictionary of plain values, along with the
+        size of the documents of the views."""
+        documents = set(view.document for view in self.views)
+        return {
+            'latency_us': dict(
+                (name, dict((1 << i, n) for i, n in enumerate(hist) if n))
+                for name, hist in self.latency.items()),
+            'p50_us': dict((name, self.percentile(name, 50))
+                           for name in self.latency),
+            'p99_us': dict((name, self.percentile(name, 99))
+                           for name in self.latency),
+            'calls': dict(self.calls),
+            'errors': self.errors,
+            'keys': self.keys,
+            'rows': self.rows,
+            'rows_per_key': self.rows / self.keys if self.keys else 0.0,
+            'repaints': dict(self.repaints),
+            'lines': sum(len(doc.text) for doc in documents),
+            'chars': sum(doc.text.size() for doc in documents),
+        }
+
+    def dump(self, path=None):
+        "Write snapshot() as JSON to path (by default self.path)."
+        with open(path or self.path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2, sort_keys=True)
+
+
+class _MeteredWindow(object):
+
+    """Window wrapper counting the calls made to it in a Metrics.
+
+    Curses errors are counted and raised again: outside of key reading
+    every one of them is swallowed by Textbox."""
+
+    _INPUT = ('getch', 'get_wch')
+
+    def __init__(self, win, metrics):
+        self.__dict__['_win'] = win
+        self.__dict__['_metrics'] = metrics
+
+    def __getattr__(self, name):
+        attr = getattr(self._win, name)
+        if not callable(attr):
+            return attr
+        metrics = self._metrics
+        calls = metrics.calls
+
+        def call(*args):
+            calls[name] = calls.get(name, 0) + 1
+            try:
+                return attr(*args)
+            except curses.error:
+                if name not in self._INPUT:
+                    metrics.errors += 1
+                raise
+        return call
+
+    def __setattr__(self, name, value):
+        setattr(self._win, name, value)
 
 
 class Textbox(object):
@@ -46,56 +2129,408 @@ class Textbox(object):
     Ctrl-N      Cursor down; move down one line.
     Ctrl-O      Insert a blank line at cursor location.
     Ctrl-P      Cursor up; move up one line.
+    Ctrl-V      Page down; move down one screen.
+    Ctrl-W      Kill (cut) the region between the mark and the cursor.
+    Ctrl-Y      Yank (paste) the last killed text.
+    Ctrl-@      Set the mark at the cursor (also Ctrl-Space).
+    Meta-W      Copy the region to the kill ring.
+    Meta-Y      Replace the text just yanked with an older kill.
+    Ctrl-X (    Start recording a keyboard macro.
+    Ctrl-X )    Stop recording the macro.
+    Ctrl-X e    Run the last macro; Ctrl-U n Ctrl-X e runs it n times.
+    Ctrl-_      Undo the last edit; a run of typing is undone at once.
+    Ctrl-^      Redo the last undone edit.
+    Ctrl-S      Search forward incrementally; again for the next match.
+    Ctrl-R      Search backward incrementally; again for the previous one.
+
+    While searching, typed characters extend the search string and
+    Backspace takes back the last character or step.  Enter ends the
+    search at the match, Ctrl-G goes back to where it started, and any
+    other key ends it and is then processed as usual.
+
+    A highlighter (see RegexHighlighter) colours the text.  The lexer
+    state at the end of every line is cached, so after an edit lexing
+    resumes at the edited line and stops as soon as a line ends in its
+    cached state again; only the rows being repainted are coloured.
+
+    Meta keys are typed as Escape followed by the key.  Killed and
+    copied text goes into a KillRing, which several views may share as
+    `kill_ring`.  A region is killed or yanked as a single buffer edit,
+    however large.
+
+    Several views can show one Document; pass it as `document`.  Edits
+    made in any of them are passed on to all of them.
+
+    append() adds text at the end of the document, and follow() keeps
+    appending what is read from a file descriptor or an iterator while
+    editing, like tail -f.  With the cursor at the end the window
+    follows the new text.  With `max_lines` the oldest lines are
+    dropped to stay within that many.  Keys are then waited for on
+    `input_fd`, stdin by default, together with the followed source.
+
+    transform() sorts, dedupes, reindents or otherwise rewrites the
+    lines of the document or the region on a thread or process pool,
+    and splices the result back as one edit; stats() counts lines,
+    words and characters the same way.  Ctrl-G cancels either.
+
+    Pass a RecoveryJournal as `journal` to log the edits in the
+    background; Textbox.recover rebuilds the text from it after a crash.
+
+    Pass a Metrics as `metrics` to record command latencies, curses
+    calls and repainted rows without changing what is shown.
+
+    With word_wrap, lines are wrapped after the last space that fits
+    on a row instead of at the window edge (see _Breaks).
+
+    Keys are read with get_wch where available.  Printable ASCII and
+    control keys arrive as integer codes like getch returns; other
+    characters are passed to do_command as one-character strings.
+    Wide (e.g. CJK) characters take two cells and are never split
+    across rows.
 
     Move operations do nothing if the cursor is at an edge where the movement
     is not possible.  The following synonyms are supported where possible:
 
     KEY_LEFT = Ctrl-B, KEY_RIGHT = Ctrl-F, KEY_UP = Ctrl-P, KEY_DOWN = Ctrl-N
     KEY_BACKSPACE = Ctrl-h
+
+    KEY_PPAGE and KEY_NPAGE page up and down, KEY_HOME and KEY_END go to
+    the beginning and the end of the document, and goto_line() jumps to
+    a line.  These find the new window position with the row index and
+    repaint the window once, however far they move.
     """
 
+    LEX_LIMIT = 10000  # longer lines are not highlighted
+    REFLOW_BATCH = 1024  # lines reflowed at a time while idle
+    FOLLOW_BATCH = 1 << 16  # bytes (or iterator items) appended at a time
+    FOLLOW_POLL = 0.25  # seconds between reads of a followed regular file
+    TRANSFORM_CHUNK = 1 << 18  # characters in each chunk of transform
+    TRANSFORM_POLL = 0.05  # seconds between checks for the cancel key
+
     def __init__(self, win, stdscr=0, text='', n_sc=1,
-                 insert_mode=True, resize_mode=False):
+                 insert_mode=True, resize_mode=False,
+                 buffer_class=RopeBuffer, hw_scroll=True, buffer=None,
+                 undo_limit=1 << 22, highlighter=None, document=None,
+                 metrics=None, kill_ring=None, journal=None,
+                 max_lines=None, word_wrap=False, input_fd=None):
 
+        # performance counters (see Metrics), off unless given
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.views.add(self)
+            win = _MeteredWindow(win, metrics)
         self.win = win
         self.stdscr = stdscr
         self.insert_mode = insert_mode
         self.resize_mode = resize_mode
         self.lastcmd = None
-        self.text = text.split('\n')
+        # the text and undo history, possibly shared with other views
+        if document is None:
+            document = Document(text, buffer_class, buffer, undo_limit,
+                                journal)
+        self.document = document
+        document.views.add(self)
+        self.text = document.text
+        self.history = document.history
+        (self.maxy, self.maxx) = self._getmaxyx()
+        (self.height, self.width) = (self.maxy + 1, self.maxx + 1)
         # virtual position of the beginning of the physical lines
-        self.lcount = [1]
+        self.lcount = RowIndex(l // self.width + 1
+                               for l in self.text.line_lengths())
+        # screen offsets of the columns of the lines holding wide or
+        # zero-width characters (see _Cells), or with word_wrap of the
+        # lines that wrap (see _Breaks); other lines have none
+        self.word_wrap = word_wrap
+        self._wide = _LineCells(len(self.text))
+        # after a resize, lines whose row counts are still those of the
+        # old width are flagged here until they are reflowed; so are
+        # the lines _measure_wide leaves to be measured
+        self._stale = None
+        self.search = None  # incremental search in progress, see _Search
+        self.replacing = None  # query-replace in progress, see _Replace
+        self.replaced = 0  # number of replacements the last replace made
+        self.highlighter = highlighter
+        # lexer state at the end of each line; those before line _valid
+        # are up to date, later ones unless _STALE
+        self._states = [_STALE] * len(self.text)
+        self._old_states = {}  # earlier states of the _STALE lines
+        self._valid = 0
+        self.last_query = ''
+        self.mark = None  # other end of the region, moved along by edits
+        self.kill_ring = kill_ring if kill_ring is not None else KillRing()
+        self._yanked = None  # (start, end) of the text just yanked
+        # Escape, ^x or ^u typed: the key it starts is still to come
+        self.prefix = None
+        self.count = None  # repeat count typed after ^u
+        self.recording = None  # keys typed since ^x (, see start_macro
+        self.macro = None  # the keys of the last macro recorded
+        self._command_start = 0  # index in recording, see _do_command
+        self.replaying = False  # window updates suspended, see call_macro
         self.ppos = (0, 0)  # physical position of the cursor
         self.vpos = (0, 0)  # virtual position of the cursor
         self.vptl = (0, 0)  # virtual position of the top-left corner
         self.n_sc = n_sc  # how many unit to scroll each time
-        (self.maxy, self.maxx) = self._getmaxyx()
-        (self.height, self.width) = (self.maxy + 1, self.maxx + 1)
+        # shift rows with the terminal's scroll/insert-line capabilities
+        self.hw_scroll = hw_scroll
+        # the oldest lines are dropped when append() goes over max_lines
+        self.max_lines = max_lines
+        self.following = None  # file descriptor read by follow
+        self._decoder = None
+        self._queue = None  # items of a followed iterator, see _drain
+        # a followed file object, kept open, and whether it is a regular
+        # file, which is read on a timer rather than when readable
+        self._follow_file = None
+        self._follow_polled = False
+        # what keys are read from, waited on with the followed source
+        self.input_fd = input_fd
+        self._held = []  # keys read while waiting for transform
+        self.damaged = set()  # screen rows to repaint on the next render
+        self._measure_wide()
 
+        self.bracketed_paste = False
+        self.pasting = False  # inside a bracketed paste
+        self._paste_cr = False  # the last key pasted was a CR
         self.refresh()
         win.keypad(1)
+        if hw_scroll:
+            win.idlok(1)
+
+    @classmethod
+    def from_file(cls, win, path, encoding='utf-8', **kwargs):
+        """Edit the file at path without reading it all in first.
+
+        The file is memory-mapped (see MappedBuffer) and its lines are
+        indexed while waiting for keys, so startup time and memory do
+        not depend on the size of the file."""
+        return cls(win, buffer=MappedBuffer(path, encoding), **kwargs)
+
+    @classmethod
+    def recover(cls, win, path, text='', buffer_class=RopeBuffer,
+                buffer=None, undo_limit=1 << 22, **kwargs):
+        """Rebuild the Textbox whose RecoveryJournal was written to path,
+        by replaying the journal over the original text (or buffer).
+
+        The replayed edits can be undone.  Pass a new journal, or the
+        same path opened again, as `journal` to keep logging."""
+
+        document = Document(text, buffer_class, buffer, undo_limit)
+        RecoveryJournal.replay(path, document)
+        document.history.seal()
+        document.journal = kwargs.pop('journal', None)
+        return cls(win, document=document, **kwargs)
 
     def _getmaxyx(self):
         (maxy, maxx) = self.win.getmaxyx()
         return maxy - 1, maxx - 1
 
-    def _addch(self, y, x, ch):
-        "self.win.addch fix: problem at lower-right corner"
+    def _beep(self):
+        "curses.beep, ignored when curses is not initialized"
+        try:
+            curses.beep()
+        except curses.error:
+            pass
+
+    def _paint_row(self, y, s):
+        "Write one screen row with a single curses call."
 
-        # TODO: unicode support: ch.encode('utf-8')?
+        s += ' ' * (self.width - _text_width(s))
         try:
-            self.win.addch(y, x, ch.encode())
-        except:
+            if y == self.maxy:
+                # addnstr cannot write the lower-right corner without
+                # moving the cursor off the window: insert the last
+                # character instead
+                k = len(s) - 1
+                while k > 0 and s[k] >= u'\u0300' and _char_width(s[k]) == 0:
+                    k -= 1
+                if k:
+                    self.win.addnstr(y, 0, s, k)
+                self.win.insnstr(y, self.width - _char_width(s[k]),
+                                 s[k:], len(s) - k)
+            else:
+                self.win.addnstr(y, 0, s, len(s))
+        except curses.error:
             pass
 
+    def _cell(self, line, col):
+        "Screen offset (row * width + x) of column col within its line."
+        cells = self._wide.get(line)
+        return col if cells is None else cells.offset(col)
+
+    def _column(self, line, cell):
+        "Column shown at screen offset cell of line, or the line's end."
+        cells = self._wide.get(line)
+        if cells is None:
+            return min(cell, self.text.line_length(line))
+        return cells.column(cell)
+
+    def _row_start(self, line, sub):
+        "First column shown on the row sub of line."
+        cells = self._wide.get(line)
+        if cells is None:
+            return sub * self.width
+        if not sub:
+            return 0
+        if isinstance(cells, _Breaks):
+            return cells.row_start(sub)
+        return cells.column(sub * self.width - 1) + 1
+
+    def _measure(self, line, s=None):
+        """Measure line again and return its number of rows; s is its
+        text if the caller already has it."""
+
+        if s is None:
+            s = self.text.get(line)
+        measure = _Breaks.measure if self.word_wrap else _Cells.measure
+        cells = measure(s, self.width)
+        if cells is None:
+            self._wide.pop(line, None)
+            return len(s) // self.width + 1
+        self._wide[line] = cells
+        return cells.end // self.width + 1
+
+    def _measure_wide(self, start=0):
+        """Flag the lines from start on with wide text, or with word_wrap
+        the ones that may wrap, to be measured: those near the window
+        right away, the others while waiting for keys (see
+        _reflow_more), as after a resize."""
+
+        lines = [i for i, s in self.text.wide_lines(start)]
+        if self.word_wrap:
+            lines += [i for i, l in enumerate(
+                self.text.line_lengths(start), start) if l >= self.width]
+        if not lines:
+            return
+        if self._stale is None:
+            self._stale = bytearray(len(self.text))
+        for i in lines:
+            self._wide.pend(i)
+            self._stale[i] = 1
+        self._reflow_near(self.vptl[0])
+
+    def _top_row(self):
+        "Visual row shown at the top of the window."
+        return (self.lcount.rows_before(self.vptl[0])
+                + self._cell(*self.vptl) // self.width)
+
+    def _row_text(self, row):
+        "Text of the visual row `row` of the document."
+
+        line, sub = self.lcount.line_at(row)
+        if line >= len(self.text):
+            return ''
+        s = self.text.get(line, self._row_start(line, sub),
+                          self._row_start(line, sub + 1))
+        if self.word_wrap and s.endswith(' ') \
+           and _text_width(s) > self.width:
+            s = s[:-1]  # a space past the edge of a full row
+        return s
+
+    def render(self):
+        """Repaint the damaged rows and put the cursor back.
+
+        Editing methods only mark the rows they change; do_command and
+        refresh call this once at the end of the command."""
+
+        if self.damaged:
+            top = self._top_row()
+            if self.highlighter is not None:
+                spans = self._lex_visible(top)
+            for y in sorted(self.damaged):
+                self._paint_row(y, self._row_text(top + y))
+            if self.highlighter is not None:
+                self._colorize(self.damaged, top, spans)
+            if self.search is not None:
+                self._highlight(self.damaged)
+            if self.replacing is not None:
+                self._highlight_replace(self.damaged)
+            self.damaged.clear()
+        self.win.move(*self.ppos)
+
+    @property
+    def nlines(self):
+        "Total number of visual rows."
+        return self.lcount.total()
+
     def do_command(self, ch):
         "Process a single editing command."
-        self.nlines = sum(self.lcount)
+        if self.recording is not None:
+            self.recording.append(ch)
+        ret = self._run_command(ch)
+        self.render_all()
+        return ret
+
+    def _run_command(self, ch):
+        "_do_command, timed if metrics are kept."
+
+        metrics = self.metrics
+        if metrics is None:
+            return self._do_command(ch)
+        t = _clock()
+        ret = self._do_command(ch)
+        metrics.time(_command_name(ch), _clock() - t)
+        metrics.keys += 1
+        return ret
+
+    def render_all(self):
+        """Render the other views of the document that have rows to
+        repaint, then this one, which gets the terminal's cursor."""
+
+        metrics = self.metrics
+        if metrics is not None:
+            t = _clock()
+        for view in list(self.document.views):
+            if view is not self and view.damaged:
+                if view.metrics is not None:
+                    view.metrics.repainted(len(view.damaged))
+                view.render()
+                view.win.noutrefresh()
+        if metrics is None:
+            self.render()
+            return
+        metrics.repainted(len(self.damaged))
+        self.render()
+        metrics.time('render', _clock() - t)
+
+    def _do_command(self, ch):
         self.lastcmd = ch
+        if self.recording is not None and self.prefix is None \
+           and self.count is None:
+            # where the keys of this command, prefixes included, start
+            self._command_start = len(self.recording) - 1
+        if not _printable(ch):
+            self.history.seal()
+
+        # keep the lines just below the viewport indexed
+        if not self.text.complete and \
+           self.vpos[0] + 2 * self.height >= len(self.text):
+            self._load_more()
+
+        if self.search is not None:
+            return self._search_command(ch)
+        if self.replacing is not None:
+            return self._replace_command(ch)
 
-        if curses.ascii.isprint(ch):
+        if self.prefix is not None:
+            prefix, self.prefix = self.prefix, None
+            if prefix == curses.ascii.ESC:
+                return self._meta_command(ch)
+            if prefix == curses.ascii.CAN:
+                return self._ctlx_command(ch)
+            # digits after ^u make up the repeat count
+            if isinstance(ch, int) and curses.ascii.isdigit(ch):
+                self.count = self.count * 10 + ch - ord('0')
+                self.prefix = prefix
+                return 1
+            if not self.count:
+                self.count = 4
+        if ch not in (curses.ascii.CAN, curses.ascii.NAK):
+            self.count = None
+        if ch != curses.ascii.ESC:
+            self._yanked = None
+
+        if _printable(ch):
             if self._insert_printable_char(ch) == 0:
-                curses.beep()
+                self._beep()
         
         elif ch == curses.KEY_RESIZE:
             self.refresh()
@@ -118,207 +2553,863 @@ class Textbox(object):
         elif ch in (curses.ascii.DLE, curses.KEY_UP):  # ^p up
             self.move_up()
 
+        elif ch in (curses.ascii.SYN, curses.KEY_NPAGE):  # ^v pgdn
+            self.page_down()
+
+        elif ch == curses.KEY_PPAGE:  # pgup
+            self.page_up()
+
+        elif ch in (curses.KEY_HOME, curses.KEY_BEG):
+            self.move_top()
+
+        elif ch == curses.KEY_END:
+            self.move_bottom()
+
         elif ch == curses.ascii.NL:  # ^j
             if self.height == 1:
                 return 0
             else:
-                if self.ppos[0] == self.maxy:
-                    self.scroll(self.n_sc)
-                self.newline()
+                if self.ppos[0] == self.maxy:
+                    self.scroll(self.n_sc)
+                self.newline()
+
+        elif ch == curses.ascii.SI:  # ^o
+            if self.ppos[0] == self.maxy:
+                self.scroll(self.n_sc)
+            self.newline()
+
+        elif ch == curses.ascii.EOT:  # ^d
+            self.delete()
+
+        elif ch in (curses.ascii.BS, curses.KEY_BACKSPACE, curses.ascii.DEL):
+            if (self.vpos[0] == 0) and (self.vpos[1] == 0):
+                self._beep()
+            else:
+                # move one left and del
+                self.move_left()
+                self.delete()
+
+        elif ch == curses.ascii.VT:  # ^k
+            if self.text.line_length(self.vpos[0]) == 0:
+                # if there is nothing in the vline
+                self.delete()
+            else:
+                self.clear_right()
+
+        elif ch == curses.ascii.FF:  # ^l
+            self.refresh()
+
+        elif ch == curses.ascii.HT:  # ^i
+            self.insert_mode = not self.insert_mode
+
+        elif ch == curses.ascii.US:  # ^_
+            self.undo()
+
+        elif ch == curses.ascii.RS:  # ^^
+            self.redo()
+
+        elif ch in (curses.ascii.DC3, curses.ascii.DC2):  # ^s ^r
+            self.start_search(ch == curses.ascii.DC3)
+
+        elif ch == curses.ascii.NUL:  # ^space
+            self.set_mark()
+
+        elif ch == curses.ascii.ETB:  # ^w
+            self.kill_region()
+
+        elif ch == curses.ascii.EM:  # ^y
+            self.yank()
+
+        elif ch in (curses.ascii.ESC, curses.ascii.CAN):  # meta ^x
+            self.prefix = ch
+
+        elif ch == curses.ascii.NAK:  # ^u
+            self.prefix = ch
+            self.count = 0
+            
+        elif ch == curses.ascii.BEL:  # ^g
+            return 0
+        
+        return 1
+
+    def _meta_command(self, ch):
+        "Process the key typed after Escape."
+
+        if ch in (ord('w'), ord('W')):
+            self.copy_region()
+        elif ch in (ord('y'), ord('Y')):
+            self.yank_pop()
+        elif ch == curses.ascii.ESC:
+            self.prefix = ch
+        else:
+            self._beep()
+        return 1
+
+    def _ctlx_command(self, ch):
+        "Process the key typed after ^x."
+
+        count, self.count = self.count, None
+        if ch == ord('('):
+            self.start_macro()
+        elif ch == ord(')'):
+            if self.recording is not None:
+                # leave out the ^x ), and a count typed before it
+                del self.recording[self._command_start:]
+            self.end_macro()
+        elif ch in (ord('e'), ord('E')):
+            return self.call_macro(count or 1)
+        else:
+            self._beep()
+        return 1
+
+    def _insert_printable_char(self, ch):
+        (line, col) = self.vpos
+        # screen row where the line starts
+        y = self.ppos[0] - self._cell(line, col) // self.width
+
+        # update text: overwrite mode replaces the character under cursor
+        if self.insert_mode == False \
+           and col < self.text.line_length(line):
+            self._apply(line, col, 1, _key_text(ch))
+        else:
+            self._apply(line, col, 0, _key_text(ch))
+
+        # update cursor position, scrolling when it leaves the window
+        cell = self._cell(line, col + 1)
+        self.ppos = (y + cell // self.width, cell % self.width)
+        self.vpos = (line, col + 1)
+        if self.ppos[0] > self.maxy:
+            self.scroll(max(self.n_sc, self.ppos[0] - self.maxy))
+        self._sync_cursor()
+
+        return 1
+
+    def _apply(self, line, col, n, s, record=True):
+        """Replace n characters at (line, col) with s and return the
+        replaced text.
+
+        All edits go through here and Document.replace, which records
+        the edit for undo and passes it on to every view of the
+        document (see _edit_end)."""
+
+        return self.document.replace(line, col, n, s, record, self)
+
+    def _edit_begin(self, line, col):
+        """Prepare for an edit at (line, col); returns what _edit_end
+        needs to know about the text before it."""
+
+        self._reflow_near(line)
+        return (self._cell(line, col) // self.width,
+                self._cell(*self.vptl) // self.width)
+
+    def _edit_end(self, line, col, old, s, begun, source):
+        """Follow the replacement of old at (line, col) by s.
+
+        The row index is updated for the lines involved, and the changed
+        rows on screen are marked for repainting while the rows below
+        are shifted into place.  A view other than the source keeps its
+        window and cursor on the same characters; an edit above its
+        window repaints nothing."""
+
+        (sub, top) = begun
+        first_row = self.lcount.rows_before(line)
+        last = line + old.count('\n')
+        if '\n' in old or '\n' in s:
+            oldrows = self.lcount.rows_before(last + 1) - first_row
+            parts = s.split('\n')
+            wide = self._renumber_wide(line, last, len(parts))
+
+            # row counts of the lines that replace line..last
+            counts = [len(p) // self.width + 1 for p in parts]
+            for i in range(len(parts)):
+                edge = i == 0 or i == len(parts) - 1
+                if edge and wide or _MAYBE_WIDE.search(parts[i]) \
+                   or self.word_wrap and self.width <= (
+                       self.text.line_length(line + i) if edge
+                       else len(parts[i])):
+                    counts[i] = self._measure(line + i)
+                elif edge:
+                    counts[i] = (self.text.line_length(line + i)
+                                 // self.width + 1)
+            self.lcount.splice(line, last + 1, counts)
+            self._restyle(line, last, len(parts))
+            newrows = sum(counts)
+        else:
+            # the common case: an edit within one line
+            oldrows = self.lcount[line]
+            ll = self.text.line_length(line)
+            cells = self._wide.get(line)
+            if self.word_wrap:
+                if cells is not None:
+                    cells.replace(col, len(old), s,
+                                  partial(self.text.get, line))
+                    if not len(cells):
+                        del self._wide[line]
+                    ll = cells.end
+                elif ll >= self.width or _MAYBE_WIDE.search(s):
+                    self._measure(line)
+                    cells = self._wide.get(line)
+                    ll = cells.end if cells is not None else ll
+            else:
+                if cells is None and _MAYBE_WIDE.search(s):
+                    cells = self._wide[line] = _Cells.blank(
+                        self.width, ll - len(s) + len(old))
+                if cells is not None:
+                    cells.replace(col, len(old), s)
+                    if not len(cells):
+                        del self._wide[line]
+                    ll = cells.end
+            newrows = ll // self.width + 1
+            self.lcount[line] = newrows
+            self._restyle(line, line, 1)
+        if not source:
+            self.vpos = _moved(self.vpos, line, col, old, s)
+        if self.mark is not None:
+            self.mark = _moved(self.mark, line, col, old, s)
+
+        vl = self.vptl[0]
+        if vl > last:
+            # above the window: only the line numbers change
+            self.vptl = _moved(self.vptl, line, col, old, s)
+            if not source:
+                self._place_cursor()
+            return
+        if vl == line:
+            # keep the same row at the top even if the columns on it
+            # have changed
+            if top >= self.lcount[line]:
+                top = self.lcount[line] - 1
+                self.redraw_vlines(None, (0, 0))
+            self.vptl = (line, self._row_start(line, top))
+        elif vl > line:
+            # the top line was removed
+            sub = self._cell(line, col) // self.width
+            self.vptl = (line, self._row_start(line, sub))
+            self.redraw_vlines(None, (0, 0))
+
+        y = first_row - self._top_row()
+        if newrows != oldrows:
+            self._shift_rows(y + oldrows, newrows - oldrows)
+        # a wide character may move between the rows around col
+        sub = min(sub, self._cell(line, col) // self.width)
+        if self.word_wrap:
+            # words may move up to the rows before
+            sub = min(sub, self._cell(line, max(col - 2 * self.width - 2, 0))
+                      // self.width)
+        if self.highlighter is not None:
+            # the colours of the whole line may change
+            sub = 0
+        self.redraw_vlines(None, (y + sub, 0), y + newrows)
+        if not source:
+            self._place_cursor()
+
+    def _restyle(self, line, last, k):
+        """Note that lines line..last were replaced by k lines, measured
+        at the current width, whose lexer states are unknown."""
+
+        if self._stale is not None:
+            self._stale[line:last + 1] = bytearray(k)
+        if self.highlighter is None:
+            return
+        if line == last and k == 1:
+            # an edit within the line: its old state tells whether the
+            # lines below need colouring again
+            if self._states[line] is not _STALE:
+                self._old_states[line] = self._states[line]
+        else:
+            self._old_states.clear()
+        self._states[line:last + 1] = [_STALE] * k
+        self._valid = min(self._valid, line)
+
+    def _lex_visible(self, top):
+        """Bring the lexer states up to date down to the last line shown,
+        marking the rows whose colours may change for repainting.
+        Returns the spans found for the lines shown that were lexed on
+        the way.
+
+        The lines are read in one pass from the first stale one; only
+        the stretch of the cache down to the last line shown is checked
+        for more stale lines once the states are in step again."""
+
+        spans = {}
+        states, lex = self._states, self.highlighter.lex
+        first = self.lcount.line_at(top)[0]
+        bottom = self.lcount.line_at(min(top + self.maxy,
+                                         self.nlines - 1))[0]
+        while self._valid < bottom:
+            i = self._valid
+            state = states[i - 1] if i else self.highlighter.initial
+            for s in self.text.lines_from(i, bottom):
+                if len(s) <= self.LEX_LIMIT:
+                    found, state = lex(state, s)
+                    if i >= first:
+                        spans[i] = found
+                old, states[i] = states[i], state
+                if old is _STALE:
+                    old = self._old_states.pop(i, _STALE)
+                i += 1
+                self._valid = i
+                if state == old:
+                    break
+                # the next line starts in another state: lex it again
+                if states[i] is not _STALE:
+                    self._old_states[i] = states[i]
+                    states[i] = _STALE
+                if i >= first:
+                    y = self.lcount.rows_before(i) - top
+                    self.redraw_vlines(None, (y, 0), y + self.lcount[i])
+            # back in step with the cache up to the next change
+            try:
+                self._valid = states.index(_STALE, self._valid, bottom)
+            except ValueError:
+                self._valid = bottom
+        return spans
+
+    def _colorize(self, rows, top, known):
+        """Colour the text on the given screen rows.  known maps lines to
+        spans already found."""
+
+        lines = {}
+        for y in rows:
+            line, sub = self.lcount.line_at(top + y)
+            if line < len(self.text):
+                lines.setdefault(line, []).append((y, sub))
+        for line, subs in lines.items():
+            if self.text.line_length(line) > self.LEX_LIMIT:
+                continue
+            spans = known.get(line)
+            if spans is None:
+                state = (self._states[line - 1] if line
+                         else self.highlighter.initial)
+                spans = self.highlighter.lex(state, self.text.get(line))[0]
+            for y, sub in subs:
+                base = sub * self.width
+                start = self._row_start(line, sub)
+                stop = self._row_start(line, sub + 1)
+                for a, b, attr in spans:
+                    a, b = max(a, start), min(b, stop)
+                    if a < b:
+                        x = self._cell(line, a) - base
+                        try:
+                            self.win.chgat(y, x, self._cell(line, b) - base
+                                           - x, attr)
+                        except curses.error:
+                            pass
+
+    def _renumber_wide(self, line, last, k):
+        """Drop the display offsets of lines line..last, which are being
+        replaced by k lines; the ones below move with their slots.
+        Returns True if any were dropped."""
+
+        return self._wide.splice(line, last, k)
+
+    def _reveal(self, line, col):
+        """Scroll so that (line, col) is on the top row unless it is
+        already shown."""
+
+        self._reflow_near(line)
+        sub = self._cell(line, col) // self.width
+        row = self.lcount.rows_before(line) + sub - self._top_row()
+        if not 0 <= row <= self.maxy:
+            self.vptl = (line, self._row_start(line, sub))
+            self.redraw_vlines(self.vptl, (0, 0))
+
+    def undo(self):
+        "Revert the last edit, or run of typing, in one step."
+
+        rec = self.history.pop_undo()
+        if rec is None:
+            self._beep()
+            return
+        (line, col, removed, inserted) = rec
+        self._reveal(line, col)
+        self._apply(line, col, len(inserted), removed, record=False)
+        self.vpos = _end_of(line, col, removed)
+        self._place_cursor()
+
+    def redo(self):
+        "Reapply the last undone edit."
+
+        rec = self.history.pop_redo()
+        if rec is None:
+            self._beep()
+            return
+        (line, col, removed, inserted) = rec
+        self._reveal(line, col)
+        self._apply(line, col, len(removed), inserted, record=False)
+        self.vpos = _end_of(line, col, inserted)
+        self._place_cursor()
+
+    def start_search(self, forward=True):
+        "Start an incremental search from the cursor."
+        self.search = _Search(self.vpos, self.vptl, forward)
+
+    def end_search(self, cancel=False):
+        """Leave the incremental search, at the match or, with cancel,
+        back where it started."""
+
+        search = self.search
+        self._mark_matches()
+        self.search = None
+        if search.query:
+            self.last_query = search.query
+        if cancel:
+            if self.vptl != search.vptl:
+                self.vptl = search.vptl
+                self.redraw_vlines(self.vptl, (0, 0))
+            self.vpos = search.origin
+            self._place_cursor()
+
+    def _search_command(self, ch):
+        "Process a key typed during an incremental search."
+
+        search = self.search
+        if _printable(ch):
+            self._search_step(search.query + _key_text(ch), search.forward)
+        elif ch in (curses.ascii.DC3, curses.ascii.DC2):  # ^s ^r
+            forward = ch == curses.ascii.DC3
+            if search.query:
+                self._search_step(search.query, forward)
+            elif self.last_query:
+                # an empty search repeats the previous one
+                self._search_step(self.last_query, forward)
+            else:
+                search.forward = forward
+        elif ch in (curses.ascii.BS, curses.KEY_BACKSPACE, curses.ascii.DEL):
+            if search.stack:
+                self._mark_matches()
+                search.restore()
+                self._jump_to(*(search.current or search.origin))
+                self._mark_matches()
+            else:
+                self._beep()
+        elif ch == curses.ascii.BEL:  # ^g
+            self.end_search(cancel=True)
+        elif ch == curses.KEY_RESIZE:
+            self.refresh()
+        elif ch in (curses.ascii.NL, curses.ascii.CR):
+            self.end_search()
+        else:
+            self.end_search()
+            return self._do_command(ch)
+        return 1
+
+    def _search_step(self, query, forward):
+        """Search for query, which the current query is a prefix of, or
+        for the next match of the current query.
+
+        A longer query only checks the previous matches, unless they
+        are on so many lines that scanning the document again costs less
+        (see _narrow)."""
+
+        search = self.search
+        self._mark_matches()
+        search.save()
+        strict = query == search.query
+        wrap = strict and search.failing and forward == search.forward
+        if not strict:
+            if search.query and query.startswith(search.query):
+                search.matches = _narrow(self.text, search.matches, query)
+            else:
+                search.matches = _find_all(self.text, query)
+            search.query = query
+        search.forward = forward
+        i = search.pick(strict, wrap)
+        search.failing = i is None
+        if i is None:
+            self._beep()
+        else:
+            search.current = _unpacked(search.matches[i])
+            self._jump_to(*search.current)
+        self._mark_matches()
+
+    def _jump_to(self, line, col):
+        """Move the cursor to (line, col).  If it is not shown the window
+        scrolls straight there, with the row in the middle."""
+
+        self._reflow_near(line)
+        cell = self._cell(line, col)
+        row = (self.lcount.rows_before(line) + cell // self.width
+               - self._top_row())
+        self.vpos = (line, col)
+        self.ppos = (row, cell % self.width)
+        if 0 <= row <= self.maxy:
+            self._sync_cursor()
+        else:
+            self.scroll(row - self.height // 2)
+
+    def _match_cells(self):
+        """Yield (row, x, n, current) for the screen cells taken by the
+        search matches shown in the window."""
+
+        search = self.search
+        matches, k = search.matches, len(search.query)
+        if not matches or not k:
+            return
+        top = self._top_row()
+        bottom = min(top + self.maxy, self.nlines - 1)
+        first, sub = self.lcount.line_at(top)
+        last, lastsub = self.lcount.line_at(bottom)
+        if first >= len(self.text):
+            return
+        lo = _packed(first, max(self._row_start(first, sub) - k + 1, 0))
+        hi = _packed(last, self._row_start(last, lastsub + 1))
+        for p in matches[bisect_left(matches, lo):
+                         bisect_left(matches, hi)]:
+            (line, col) = _unpacked(p)
+            current = (line, col) == search.current
+            for y, x, n in self._span_cells(line, col, k, top):
+                yield (y, x, n, current)
+
+    def _span_cells(self, line, col, k, top):
+        """Yield (row, x, n) for the screen cells taken by the k
+        characters at (line, col), with the visual row top at the top."""
+
+        w = self.width
+        a = self._cell(line, col)
+        b = self._cell(line, col + k)
+        y = self.lcount.rows_before(line) - top
+        for r in range(a // w, (b - 1) // w + 1):
+            x = max(a - r * w, 0)
+            yield (y + r, x, min(b - r * w, w) - x)
+
+    def _mark_matches(self):
+        "Mark the rows showing search matches for repainting."
+        self.damaged.update(y for y, x, n, current in self._match_cells()
+                            if 0 <= y < self.height)
+
+    def _highlight(self, rows):
+        "Highlight the search matches on the given screen rows."
+
+        for y, x, n, current in self._match_cells():
+            if y in rows:
+                try:
+                    self.win.chgat(y, x, n, curses.A_REVERSE if current
+                                   else curses.A_UNDERLINE)
+                except curses.error:
+                    pass
+
+    def replace_all(self, query, replacement, regex=False, region=False):
+        """Replace every occurrence of query, within the region with
+        region, by replacement and return how many were replaced.
+
+        With regex, query is a regular expression and replacement may
+        refer to its groups as in re.sub.  Matches do not span lines.
+        The text is scanned once; the lines from the first to the last
+        one changed are replaced with one buffer edit, undone at once,
+        and the window is repainted once."""
+
+        if not query:
+            raise ValueError('empty query')
+        if region:
+            r = self._region()
+            if r is None:
+                return 0
+            (start, end) = r
+        else:
+            while not self.text.complete:
+                self._load_more()
+            last = len(self.text) - 1
+            (start, end) = ((0, 0), (last, self.text.line_length(last)))
+        self.replaced = self._replace_range(
+            _Replace(query, replacement, regex, end), start)
+        return self.replaced
+
+    def _replace_range(self, rep, start):
+        """Replace the matches of rep from start to rep.end as one edit
+        and return their number."""
+
+        end = rep.end
+        lines = []  # the lines from the first one changed on
+        first = last = None
+        count = n = 0
+        for i, s in enumerate(self.text.lines_from(start[0], end[0] + 1),
+                              start[0]):
+            a = start[1] if i == start[0] else 0
+            b = end[1] if i == end[0] else len(s)
+            if rep.regex:
+                # match within the whole line, as query_replace does, so
+                # that ^, \b and lookbehinds see the text around a..b
+                pieces = []
+                k = 0
+                p = a
+                for m in rep.pattern.finditer(s, a, b):
+                    pieces += [s[p:m.start()], m.expand(rep.replacement)]
+                    p = m.end()
+                    k += 1
+                if k:
+                    new = ''.join(pieces) + s[p:b]
+            else:
+                k = s.count(rep.query, a, b)
+                if k:
+                    new = s[a:b].replace(rep.query, rep.replacement)
+            if first is not None:
+                n += len(s) + 1
+                lines.append(s)
+            if k:
+                count += k
+                if first is None:
+                    first = i
+                    n = len(s) + 1
+                    lines.append(s)
+                last = i
+                lines[-1] = s[:a] + new + s[b:]
+        if not count:
+            return 0
+        # n counts the old lengths: leave out the lines after the last
+        # one changed, and the final newline
+        n -= sum(len(s) + 1 for s in lines[last - first + 1:]) + 1
+        del lines[last - first + 1:]
+        s = '\n'.join(lines)
+        (line, col) = self.vpos
+        old = self._apply(first, 0, n, s)
+        if first <= line <= last and old.count('\n') == s.count('\n'):
+            self.vpos = (line, min(col, self.text.line_length(line)))
+        else:
+            self.vpos = _moved(self.vpos, first, 0, old, s)
+        self._place_cursor()
+        return count
 
-        elif ch == curses.ascii.SI:  # ^o
-            if self.ppos[0] == self.maxy:
-                self.scroll(self.n_sc)
-            self.newline()
+    def query_replace(self, query, replacement, regex=False, region=False):
+        """Replace occurrences of query one at a time, asking with each.
 
-        elif ch == curses.ascii.EOT:  # ^d
-            self.delete()
+        Goes through the matches from the cursor, or in the region with
+        region.  On each one, y or Space replaces it, n or Backspace
+        skips it, ! replaces all the rest at once, and q, Enter or
+        Ctrl-G stops; any other key stops and is processed as usual.
+        self.replaced then holds the number of replacements."""
 
-        elif ch in (curses.ascii.BS, curses.KEY_BACKSPACE, curses.ascii.DEL):
-            if (self.vpos[0] == 0) and (self.vpos[1] == 0):
-                curses.beep()
-            else:
-                # move one left and del
-                self.move_left()
-                self.delete()
+        if not query:
+            raise ValueError('empty query')
+        start, end = self.vpos, None
+        if region:
+            r = self._region()
+            if r is None:
+                return
+            (start, end) = r
+        self.replaced = 0
+        self.replacing = _Replace(query, replacement, regex, end)
+        self._replace_next(start)
 
-        elif ch == curses.ascii.VT:  # ^k
-            if len(self.text[self.vpos[0]]) == 0:
-                # if there is nothing in the vline
-                self.delete()
-            else:
-                self.clear_right()
+    def _replace_command(self, ch):
+        "Process a key typed during a query-replace."
 
-        elif ch == curses.ascii.FF:  # ^l
+        rep = self.replacing
+        if ch in (ord('y'), ord(' ')):
+            (line, col, m) = rep.current
+            s = rep.expand(m)
+            self.history.seal()
+            old = self._apply(line, col, len(m.group()), s)
+            if rep.end is not None:
+                rep.end = _moved(rep.end, line, col, old, s)
+            rep.current = None
+            rep.count += 1
+            self.vpos = _end_of(line, col, s)
+            self._place_cursor()
+            self._replace_next(self.vpos, not m.group())
+        elif ch in (ord('n'), curses.ascii.BS, curses.KEY_BACKSPACE,
+                    curses.ascii.DEL):
+            (line, col, m) = rep.current
+            self._replace_next((line, m.end()), not m.group())
+        elif ch == ord('!'):
+            (line, col, m) = rep.current
+            if rep.end is None:
+                while not self.text.complete:
+                    self._load_more()
+                last = len(self.text) - 1
+                rep.end = (last, self.text.line_length(last))
+            self._mark_replace()
+            rep.current = None
+            rep.count += self._replace_range(rep, (line, col))
+            self.end_replace()
+        elif ch in (ord('q'), curses.ascii.NL, curses.ascii.CR,
+                    curses.ascii.BEL):
+            self.end_replace()
+        elif ch == curses.KEY_RESIZE:
             self.refresh()
-
-        elif ch == curses.ascii.HT:  # ^i
-            self.insert_mode = not self.insert_mode
-            
-        elif ch == curses.ascii.BEL:  # ^g
-            return 0
-        
+        else:
+            self.end_replace()
+            return self._do_command(ch)
         return 1
 
-    def _insert_printable_char(self, ch):
-        trailingstr = self.text[self.vpos[0]][self.vpos[1]:]
+    def _replace_next(self, pos, skip_empty=False):
+        """Move to the first match from pos on, ending the query-replace
+        if there is none.  With skip_empty an empty match at pos does
+        not count."""
 
-        # overwrite mode
-        if self.insert_mode == False:
-            self.text[self.vpos[0]]\
-                = self.text[self.vpos[0]][:self.vpos[1]] + chr(ch) \
-                + trailingstr[1:]
-            self._addch(self.ppos[0], self.ppos[1], chr(ch).encode())
-            self.ppos = self.win.getyx()
-            self.vpos = (self.vpos[0], self.vpos[1]+1)
+        rep = self.replacing
+        self._mark_replace()
+        (line, col) = pos
+        end = rep.end
+        while line < len(self.text) and (end is None or line <= end[0]):
+            s = self.text.get(line)
+            stop = end[1] if end is not None and line == end[0] else len(s)
+            m = rep.pattern.search(s, col, stop)
+            if m is not None and skip_empty and not m.group() \
+               and m.start() == pos[1] and line == pos[0]:
+                m = rep.pattern.search(s, col + 1, stop) \
+                    if col < stop else None
+            if m is not None:
+                rep.current = (line, m.start(), m)
+                self._jump_to(line, m.start())
+                self._mark_replace()
+                return
+            line += 1
+            col = 0
+            if end is None and not self.text.complete and \
+               line + 1 >= len(self.text):
+                self._load_more()
+        self.end_replace()
 
-            return 1
-        
-        # update text
-        self.text[self.vpos[0]]\
-            = self.text[self.vpos[0]][:self.vpos[1]] + chr(ch) \
-            + trailingstr
-            
-        # update line count
-        self.lcount[self.vpos[0]] = len(
-            self.text[self.vpos[0]]) // self.width + 1
-        self.nlines = sum(self.lcount)
+    def end_replace(self):
+        "Leave the query-replace."
 
-        # redraw!
+        self._mark_replace()
+        self.replaced = self.replacing.count
+        self.replacing = None
 
-        if self.ppos[0] == self.maxy and self.ppos[1] == self.maxx:
-            self.scroll(self.n_sc)
-            (backy, backx) = self.win.getyx()
+    def _replace_cells(self):
+        "Screen cells (row, x, n) of the match the query-replace is on."
 
-        else:
-            (backy, backx) = self.win.getyx()
-            self.redraw_vlines(self.vpos, self.ppos)
+        current = self.replacing.current
+        if current is None:
+            return ()
+        (line, col, m) = current
+        return self._span_cells(line, col, max(len(m.group()), 1),
+                                self._top_row())
 
-        # update cursor position
-        if backx + 1 == self.width:
-            self.ppos = (backy + 1, 0)
-        else:
-            self.ppos = (backy, backx + 1)
-        self.vpos = (self.vpos[0], self.vpos[1] + 1)
-        self.win.move(*self.ppos)
+    def _mark_replace(self):
+        "Mark the rows showing the query-replace match for repainting."
+        self.damaged.update(y for y, x, n in self._replace_cells()
+                            if 0 <= y < self.height)
 
-        return 1
+    def _highlight_replace(self, rows):
+        "Highlight the query-replace match on the given screen rows."
 
-    def redraw_vlines(self, vpos, ppos):
-        "Redraw vlines starting from vpos to the end at ppos"
-
-        # clear the redrawn part
-        for i in range(ppos[1], self.width):
-            self._addch(ppos[0], i, ' ')
-        for l in range(ppos[0] + 1, self.height):
-            self.clear_line(l)
-
-        # now draw each characters
-        ln = ppos[0]
-        cn = ppos[1] % self.width
-
-        # first vline: continuation from the existing vline
-        for j in range(vpos[1], len(self.text[vpos[0]])):
-            self._addch(ln, cn, self.text[vpos[0]][j])
-            if cn + 1 == self.width:
-                ln += 1
-                if ln == self.height:
-                    break
-            cn = (cn + 1) % self.width
+        for y, x, n in self._replace_cells():
+            if y in rows:
+                try:
+                    self.win.chgat(y, x, n, curses.A_REVERSE)
+                except curses.error:
+                    pass
 
-        cn = 0
-        ln += 1
+    def _shift_rows(self, y, n):
+        """Move the rows from y to the bottom by n rows (up if negative)
+        and mark the rows uncovered by the move for repainting."""
 
-        # the rest of the vlines
-        for i in range(vpos[0] + 1, len(self.text)):
-            for j in range(len(self.text[i])):
-                if ln == self.height:
-                    return
+        first = min(y, y + n)
+        if n == 0:
+            return
+        if not self.hw_scroll or self.replaying or first < 0 \
+           or abs(n) >= self.height - first:
+            self.redraw_vlines(None, (first, 0))
+            return
+        if first == 0:
+            self.win.scrollok(1)
+            self.win.scrl(-n)
+            self.win.scrollok(0)
+        else:
+            self.win.move(first, 0)
+            self.win.insdelln(n)
 
-                self._addch(ln, cn, self.text[i][j])
+        # pending damage moves along with the rows
+        self.damaged = set(
+            r if r < first else r + n for r in self.damaged
+            if r < first or first <= r + n < self.height)
+        if n > 0:
+            self.damaged.update(range(y, y + n))
+        else:
+            self.damaged.update(range(self.height + n, self.height))
 
-                if cn + 1 == self.width:
-                    ln += 1
-                cn = (cn + 1) % self.width
-            cn = 0
-            ln += 1
+    def redraw_vlines(self, vpos, ppos, stop=None):
+        """Mark the rows from ppos (showing vpos) down to stop, or the
+        bottom of the window, for repainting."""
 
-        return
+        if stop is None or stop > self.height:
+            stop = self.height
+        self.damaged.update(range(max(ppos[0], 0), stop))
 
     def move_front(self):
+        (line, col) = self.vpos
+        sub = self._cell(line, col) // self.width
         self.ppos = (self.ppos[0], 0)
-        self.vpos = (
-            self.vpos[0], self.vpos[1] // self.width * self.width)
-        self.win.move(self.ppos[0], self.ppos[1])
+        self.vpos = (line, self._row_start(line, sub))
+        self._sync_cursor()
 
     def move_end(self):
+        (line, col) = self.vpos
+        sub = self._cell(line, col) // self.width
         # within a vline
-        if (self.vpos[1] // self.width + 1) < self.lcount[self.vpos[0]]:
-            self.ppos = (self.ppos[0], self.maxx)
-            self.vpos = (self.vpos[0],
-                         int((self.vpos[1] // self.width + 1) * self.width - 1))
+        if sub + 1 < self.lcount[line]:
+            col = self._row_start(line, sub + 1) - 1
         # at the end of vline
         else:
-            self.ppos = (self.ppos[0],
-                         len(self.text[self.vpos[0]]) % self.width)
-            self.vpos = (self.vpos[0], len(self.text[self.vpos[0]]))
+            col = self.text.line_length(line)
+        self.ppos = (self.ppos[0], self._cell(line, col) % self.width)
+        self.vpos = (line, col)
 
-        self.win.move(self.ppos[0], self.ppos[1])
+        self._sync_cursor()
 
     def move_left(self):
 
-        if self.ppos[1] > 0:
-            self.ppos = (self.ppos[0], self.ppos[1] - 1)
-            self.vpos = (self.vpos[0], self.vpos[1] - 1)
+        (line, col) = self.vpos
         # no space to move
-        elif self.vpos[0] == 0 and self.vpos[1] == 0:
-            curses.beep()
+        if line == 0 and col == 0:
+            self._beep()
             return
+        # within the same vline
+        if col:
+            col -= 1
+            cell = self._cell(line, col)
+            up = self._cell(line, col + 1) // self.width - cell // self.width
+        # move up to previous vline
         else:
-            if self.ppos[0] == 0:
-                self.scroll(-self.n_sc)
-            # move up to previous vline
-            if self.vpos[1] == 0:
-                ll = len(self.text[self.vpos[0] - 1])
-                self.vpos = (self.vpos[0] - 1, ll)
-                self.ppos = (self.ppos[0] - 1, ll % (self.width))
-            # move up within the same vline
-            else:
-                self.vpos = (self.vpos[0], self.vpos[1] - 1)
-                self.ppos = (self.ppos[0] - 1, self.maxx)
-        self.win.move(self.ppos[0], self.ppos[1])
+            line -= 1
+            col = self.text.line_length(line)
+            cell = self._cell(line, col)
+            up = 1
+        if up and self.ppos[0] == 0:
+            self.scroll(-self.n_sc)
+        self.vpos = (line, col)
+        self.ppos = (self.ppos[0] - up, cell % self.width)
+        self._sync_cursor()
 
     def move_right(self):
 
-        ll = len(self.text[self.vpos[0]])
+        (line, col) = self.vpos
+        ll = self.text.line_length(line)
+        if col < ll:
+            cell = self._cell(line, col + 1)
 
-        if (self.ppos[1] < self.maxx) and (self.vpos[1] < ll):
-            self.ppos = (self.ppos[0], self.ppos[1] + 1)
-            self.vpos = (self.vpos[0], self.vpos[1] + 1)
+        if col < ll and cell // self.width \
+           == self._cell(line, col) // self.width:
+            self.ppos = (self.ppos[0], cell % self.width)
+            self.vpos = (line, col + 1)
         # no space to move
-        elif ((self.vpos[0] + 1) == len(self.text)) \
-                and (self.vpos[1] == ll):
-            curses.beep()
+        elif (line + 1) == len(self.text) and col == ll:
+            self._beep()
             return
         else:
             if self.ppos[0] == self.maxy:
                 self.scroll(self.n_sc)
             # move down to next vline
-            if self.vpos[1] == ll:
-                self.vpos = (self.vpos[0] + 1, 0)
+            if col == ll:
+                self.vpos = (line + 1, 0)
                 self.ppos = (self.ppos[0] + 1, 0)
             # move down within the same vline
             else:
-                self.vpos = (self.vpos[0], self.vpos[1] + 1)
-                self.ppos = (self.ppos[0] + 1, 0)
-        self.win.move(self.ppos[0], self.ppos[1])
+                self.vpos = (line, col + 1)
+                self.ppos = (self.ppos[0] + 1, cell % self.width)
+        self._sync_cursor()
 
     def move_down(self):
 
+        (line, col) = self.vpos
+        cell = self._cell(line, col)
         # no more space to move down
-        if (self.vpos[0] + 1) == len(self.text)\
-           and (self.vpos[1] // self.width + 1) == self.lcount[self.vpos[0]]:
-            curses.beep()
+        if (line + 1) == len(self.text)\
+           and (cell // self.width + 1) == self.lcount[line]:
+            self._beep()
             return
 
         else:
@@ -327,157 +3418,601 @@ class Textbox(object):
                 self.scroll(self.n_sc)
 
             # within the same vline
-            if (self.vpos[1] // self.width + 1) < self.lcount[self.vpos[0]]:
-                ll = len(self.text[self.vpos[0]])
-                vpos1 = min(self.vpos[1] + self.width, ll)
-                self.vpos = (
-                    self.vpos[0], vpos1)
-                self.ppos = (self.ppos[0] + 1,
-                             vpos1 % self.width)
+            if (cell // self.width + 1) < self.lcount[line]:
+                col = self._column(line, cell + self.width)
             # move to next vline
             else:
-                ll = len(self.text[self.vpos[0] + 1])
-                vpos1 = min(self.vpos[1] % self.width, ll)
-                self.vpos = (self.vpos[0] + 1,
-                             vpos1)
-                self.ppos = (self.ppos[0] + 1, vpos1 % self.width)
-            self.win.move(self.ppos[0], self.ppos[1])
+                line += 1
+                col = self._column(line, cell % self.width)
+            self.vpos = (line, col)
+            self.ppos = (self.ppos[0] + 1,
+                         self._cell(line, col) % self.width)
+            self._sync_cursor()
 
     def move_up(self):
 
+        (line, col) = self.vpos
+        cell = self._cell(line, col)
         # cursor at the top
         if self.ppos[0] == 0:
-            if self.vpos[0] == 0 and self.vpos[1] < self.width:
-                curses.beep()
+            if line == 0 and cell < self.width:
+                self._beep()
                 return
             else:
                 self.scroll(-self.n_sc)
 
         # move to previous vline
-        if self.vpos[1] < self.width:
-            ll = len(self.text[self.vpos[0] - 1])
-            vpos1 = min(int((ll // self.width) * self.width) + self.vpos[1],
-                        ll)
-            self.vpos = (self.vpos[0] - 1, vpos1)
-            self.ppos = (self.ppos[0] - 1,
-                         min(self.ppos[1], ll % self.width))
+        if cell < self.width:
+            line -= 1
+            end = self._cell(line, self.text.line_length(line))
+            col = self._column(line, end // self.width * self.width + cell)
         # within the same vline
         else:
-            self.vpos = (self.vpos[0], self.vpos[1] - self.width)
-            self.ppos = (self.ppos[0] - 1, self.ppos[1])
+            col = self._column(line, cell - self.width)
+        self.vpos = (line, col)
+        self.ppos = (self.ppos[0] - 1, self._cell(line, col) % self.width)
+
+        self._sync_cursor()
+
+    def set_mark(self):
+        "Set the mark at the cursor."
+        self.mark = self.vpos
+
+    def _region(self):
+        """Start and end of the region, or None with a beep if there is
+        no mark."""
+
+        if self.mark is None:
+            self._beep()
+            return None
+        return tuple(sorted((self.mark, self.vpos)))
+
+    def _span(self, start, end):
+        """Number of characters from start to end, counted over those
+        lines only (offset() may sum every line before them)."""
+
+        return sum(self.text.line_length(i) + 1
+                   for i in range(start[0], end[0])) - start[1] + end[1]
+
+    def kill_region(self):
+        """Delete the region, as one edit, and put it in the kill
+        ring."""
+
+        region = self._region()
+        if region is None:
+            return
+        start, end = region
+        n = self._span(start, end)
+        self.kill_ring.push(self._apply(start[0], start[1], n, ''))
+        self.mark = None
+        self.vpos = start
+        self._place_cursor()
+
+    def copy_region(self):
+        "Put the text of the region in the kill ring."
+
+        region = self._region()
+        if region is None:
+            return
+        start, end = region
+        if start[0] == end[0]:
+            s = self.text.get(start[0], start[1], end[1])
+        else:
+            s = '\n'.join(chain(
+                [self.text.get(start[0], start[1])],
+                (self.text.get(i) for i in range(start[0] + 1, end[0])),
+                [self.text.get(end[0], 0, end[1])]))
+        self.kill_ring.push(s)
+        self.mark = None
+
+    def yank(self):
+        """Insert the last killed text at the cursor, as one edit, and
+        set the mark at its start."""
+
+        s = self.kill_ring.yank()
+        if s is None:
+            self._beep()
+            return
+        self.mark = self.vpos
+        self.insert_text(s)
+        self._yanked = (self.mark, self.vpos)
+
+    def yank_pop(self):
+        """Replace the text inserted by the previous yank with the next
+        older kill."""
+
+        if self._yanked is None or len(self.kill_ring.kills) < 2:
+            self._beep()
+            return
+        (start, end) = self._yanked
+        n = self._span(start, end)
+        s = self.kill_ring.rotate()
+        self._apply(start[0], start[1], n, s)
+        self.mark = start
+        self.vpos = _end_of(start[0], start[1], s)
+        self._yanked = (start, self.vpos)
+        self._place_cursor()
+
+    def start_macro(self):
+        "Start recording the keys typed as a keyboard macro."
+        self.recording = []
+
+    def end_macro(self):
+        "Stop recording; the keys typed since start_macro become the macro."
+
+        if self.recording is None:
+            self._beep()
+            return
+        self.macro = self.recording
+        self.recording = None
+
+    def call_macro(self, n=1):
+        """Replay the last macro n times.
+
+        The keys of all the repetitions go through feed as one batch,
+        so runs of typing are inserted together, and the window is only
+        repainted once at the end: rows are not shifted on the screen
+        and the cursor is not moved while replaying, the rows to repaint
+        are just collected.
+        Returns 0 if the macro terminated editing, 1 otherwise."""
+
+        if self.macro is None or self.recording is not None \
+           or self.replaying:
+            self._beep()
+            return 1
+        self.replaying = True
+        try:
+            return self._feed(self.macro * n)
+        finally:
+            self.replaying = False
+            self._sync_cursor()
+
+    def page_down(self):
+        "Move the cursor and the window down one screen."
+        self._page(max(self.height - 1, 1))
+
+    def page_up(self):
+        "Move the cursor and the window up one screen."
+        self._page(-max(self.height - 1, 1))
+
+    def _page(self, n):
+        """Move the cursor n visual rows, keeping its screen row and x
+        where the document allows."""
+
+        (line, col) = self.vpos
+        cell = self._cell(line, col)
+        row = self.lcount.rows_before(line) + cell // self.width
+        target = max(0, min(row + n, self.nlines - 1))
+        if target == row:
+            self._beep()
+            return
+        line, sub = self.lcount.line_at(target)
+        col = self._column(line, sub * self.width + cell % self.width)
+        self._show(line, col, self.ppos[0])
+
+    def move_top(self):
+        "Go to the beginning of the document."
+        self._show(0, 0, 0)
+
+    def move_bottom(self):
+        "Go to the end of the document, loading all of it first."
 
-        self.win.move(self.ppos[0], self.ppos[1])
+        while not self.text.complete:
+            self._load_more()
+        line = len(self.text) - 1
+        self._show(line, self.text.line_length(line), self.maxy)
+
+    def goto_line(self, line, col=0):
+        """Go to column col of line (both counting from 0), shown in
+        the middle of the window.  Out of range values are clamped."""
+
+        while not self.text.complete and line >= len(self.text):
+            self._load_more()
+        line = max(0, min(line, len(self.text) - 1))
+        col = max(0, min(col, self.text.line_length(line)))
+        self._show(line, col, self.height // 2)
+
+    def _show(self, line, col, y):
+        """Put the cursor on (line, col) and scroll so that it is on
+        screen row y, or as close to it as the top of the document
+        allows.
+
+        The window position comes straight from the row index, so the
+        cost does not depend on the distance moved; rows still shown
+        are shifted and the others are repainted on the next render."""
+
+        self._reflow_near(line)
+        cell = self._cell(line, col)
+        row = self.lcount.rows_before(line) + cell // self.width
+        top = max(row - min(y, self.maxy), 0)
+        n = top - self._top_row()
+        if n:
+            first, sub = self.lcount.line_at(top)
+            self.vptl = (first, self._row_start(first, sub))
+            self._shift_rows(max(n, 0), -n)
+        self.vpos = (line, col)
+        self.ppos = (row - top, cell % self.width)
+        self._sync_cursor()
 
     def scroll(self, n):
         "Scroll down/up by n unit (positive for down)"
 
-        # scroll up to previous vline
-        if (self.vptl[1] + self.width * n) < 0:
-            self.vptl = (self.vptl[0] + n,
-                         len(self.text[self.vptl[0] + n]) / self.width * self.width)
-        # scroll up/down within the same vline
-        elif (self.vptl[1] + self.width * n) <= len(self.text[self.vptl[0]]):
-            self.vptl = (self.vptl[0], self.vptl[1] + self.width * n)
-        # scroll down to next vline
-        else:
-            self.vptl = (self.vptl[0] + n, 0)
+        top = self._top_row()
+        n = max(-top, min(n, self.nlines - 1 - top))
+        line, sub = self.lcount.line_at(top + n)
+        if self._stale is not None:
+            self._reflow_near(line)
+            top = self._top_row()
+            n = max(-top, min(n, self.nlines - 1 - top))
+            line, sub = self.lcount.line_at(top + n)
+        self.vptl = (line, self._row_start(line, sub))
         self.ppos = (self.ppos[0] - n, self.ppos[1])
 
-        self.redraw_vlines(self.vptl, (0, 0))
-        self.win.move(*self.ppos)
+        # shift the existing rows and draw only the uncovered ones
+        self._shift_rows(max(n, 0), -n)
+        self._sync_cursor()
 
     def delat(self, vpos):
         "Delete chracter at position vpos"
 
-        # del within a vline
-        if vpos[1] < len(self.text[vpos[0]]):
-            self.text[vpos[0]]\
-                = self.text[vpos[0]][:vpos[1]]\
-                + self.text[vpos[0]][vpos[1] + 1:]
-        # del at the end of a line
-        else:
-            self.text[vpos[0]]\
-                += self.text[vpos[0] + 1]
-            self.text.pop(vpos[0] + 1)
-            self.lcount.pop(vpos[0] + 1)
-
-        self.lcount[vpos[0]] = len(self.text[vpos[0]]) // self.width + 1
-        self.nlines = sum(self.lcount)
-
-        for i in range(self.ppos[1], self.width):
-            self._addch(self.ppos[0], i, ' ')
-
-        self.redraw_vlines(vpos, self.ppos)
+        self._apply(vpos[0], vpos[1], 1, '')
 
     def delete(self):
         if (self.vpos[0] == len(self.text) - 1)\
-           and (self.vpos[1] == len(self.text[self.vpos[0]])):
-            curses.beep()
+           and (self.vpos[1] == self.text.line_length(self.vpos[0])):
+            self._beep()
         else:
             backy, backx = self.ppos
+            wide = self.vpos[0] in self._wide
             self.delat(self.vpos)
-            self.ppos = (backy, backx)
-            self.win.move(self.ppos[0], self.ppos[1])
+            if wide or self.vpos[0] in self._wide:
+                # a wide character may now fit where the cursor was
+                self._place_cursor()
+            else:
+                self.ppos = (backy, backx)
+                self._sync_cursor()
 
     def clear_line(self, ln):
         "Clear one line at the line number ln"
 
-        for i in range(self.width):
-            self._addch(ln, i, ' ')
+        self._paint_row(ln, '')
 
     def clear_right(self):
         "Clear right side of the cursor."
 
         backy, backx = self.ppos
+        wide = self.vpos[0] in self._wide
         # update text
-        self.text[self.vpos[0]]\
-            = self.text[self.vpos[0]][:self.vpos[1]]
-
-        # update line count
-        self.lcount[self.vpos[0]] = len(
-            self.text[self.vpos[0]]) // self.width + 1
-        self.nlines = sum(self.lcount)
-
-        # redraw the vlines
-        self.redraw_vlines(self.vpos, self.ppos)
+        self._apply(self.vpos[0], self.vpos[1], self.text.line_length(
+            self.vpos[0]) - self.vpos[1], '')
 
         # set the cursor back
-        self.ppos = (backy, backx)
-        self.win.move(self.ppos[0], self.ppos[1])
+        if wide:
+            # a wide character may now fit where the cursor was
+            self._place_cursor()
+        else:
+            self.ppos = (backy, backx)
+            self._sync_cursor()
 
     def newline(self):
         "Insert a new line. Move lines below by one."
 
-        # update texts
-        self.text.insert(
-            self.vpos[0] + 1, self.text[self.vpos[0]][self.vpos[1]:])
-        self.text[self.vpos[0]] = self.text[
-            self.vpos[0]][:self.vpos[1]]
-
-        # update the line counts
-        self.lcount.insert(self.vpos[0] + 1,
-                           len(self.text[self.vpos[0] + 1]) // self.width + 1)
-        self.lcount[self.vpos[0]] = len(
-            self.text[self.vpos[0]]) // self.width + 1
-        self.nlines = sum(self.lcount)
-
-        # clear the right part of the pline
-        for c in range(self.ppos[1], self.width):
-            self._addch(self.ppos[0], c, ' ')
+        # update texts and redraw the rest of the pline and the new line
+        self._apply(self.vpos[0], self.vpos[1], 0, '\n')
 
         # move p- and v- cursors
-        self.ppos = (self.ppos[0] + 1, 0)
-        backy, backx = self.ppos
         self.vpos = (self.vpos[0] + 1, 0)
+        self._place_cursor()
 
-        # redraw the bottom lines
-        self.redraw_vlines(self.vpos, self.ppos)
+    def insert_text(self, s):
+        """Insert s, which may span several lines, at the cursor as one
+        buffer edit and move the cursor to its end."""
 
-        # move the cursor position back
-        self.ppos = (backy, backx)
-        self.win.move(*self.ppos)
+        self._apply(self.vpos[0], self.vpos[1], 0, s)
+        self.vpos = _end_of(self.vpos[0], self.vpos[1], s)
+        self._place_cursor()
+
+    def overwrite_text(self, s):
+        """Write s over the text after the cursor as one buffer edit and
+        move the cursor to its end.  As when typing in overwrite mode,
+        each character of s, newlines included, replaces one up to the
+        end of the line."""
+
+        (line, col) = self.vpos
+        n = min(len(s), self.text.line_length(line) - col)
+        self._apply(line, col, n, s)
+        self.vpos = _end_of(line, col, s)
+        self._place_cursor()
+
+    def append(self, s):
+        """Add s at the end of the document as one edit, which is not
+        recorded for undo.
+
+        A cursor at the end stays at the end, scrolling the window with
+        the terminal's scrolling so only the new rows are drawn.  Lines
+        over max_lines are then dropped from the top."""
+
+        while not self.text.complete:
+            self._load_more()
+        line = len(self.text) - 1
+        end = (line, self.text.line_length(line))
+        pinned = self.vpos == end
+        self._apply(line, end[1], 0, s, record=False)
+        if self.max_lines is not None and len(self.text) > self.max_lines:
+            self._drop_lines(len(self.text) - self.max_lines)
+        if pinned:
+            line = len(self.text) - 1
+            self.vpos = (line, self.text.line_length(line))
+        self._place_cursor()
+
+    def transform(self, op, region=False, executor=None,
+                  cancel=curses.ascii.BEL):
+        """Replace the lines of the document, or those of the region
+        with region, by op applied to them, and return True; or return
+        False, leaving the text alone, if the cancel key is typed
+        before op is done.
+
+        op is a LineMap, SortLines, UniqueLines, Reindent or another
+        object with their map and combine methods.  It is mapped over
+        chunks of lines on executor, a thread pool of its own by
+        default; pass a concurrent.futures.ProcessPoolExecutor to use
+        several cores.  The result is spliced in with one buffer edit,
+        undone at once, and the window is repainted once.  The cursor
+        keeps its line number."""
+
+        r = self._line_range(region)
+        if r is None:
+            return True
+        (a, b) = r
+        mapped = self._map_chunks(op.map, a, b, executor, cancel)
+        if mapped is None:
+            return False
+        (results, n) = mapped
+        lines = list(op.combine(results))
+        (line, col) = self.vpos
+        self._apply(a, 0, n, '\n'.join(lines))
+        if line > b:
+            line += len(lines) - (b - a + 1)
+        elif line >= a:
+            line = min(line, a + max(len(lines) - 1, 0))
+        self.vpos = (line, min(col, self.text.line_length(line)))
+        self._place_cursor()
+        return True
+
+    def stats(self, region=False, executor=None, cancel=curses.ascii.BEL):
+        """Count the lines, words and characters (newlines included) of
+        the document, or of the lines of the region with region, in
+        chunks on executor as transform does.  Returns a dict with keys
+        'lines', 'words' and 'chars', or None if cancelled."""
+
+        r = self._line_range(region)
+        if r is None:
+            return {'lines': 0, 'words': 0, 'chars': 0}
+        mapped = self._map_chunks(_count_lines, r[0], r[1], executor,
+                                  cancel)
+        if mapped is None:
+            return None
+        (lines, words, chars) = (sum(c) for c in zip(*mapped[0]))
+        return {'lines': lines, 'words': words, 'chars': chars - 1}
+
+    def _line_range(self, region):
+        """The first and last line of the region, without a last line
+        it only reaches the start of, or of the whole document; None
+        if there is no region."""
+
+        if region:
+            r = self._region()
+            if r is None:
+                return None
+            (start, end) = r
+            if end[1] == 0 and end[0] > start[0]:
+                return (start[0], end[0] - 1)
+            return (start[0], end[0])
+        while not self.text.complete:
+            self._load_more()
+        return (0, len(self.text) - 1)
+
+    def _map_chunks(self, func, a, b, executor, cancel):
+        """func applied on executor to lines a to b, in chunks of about
+        TRANSFORM_CHUNK characters.  Returns the results in order and
+        the number of characters in the lines, or None if cancel was
+        typed first."""
+
+        own = executor is None
+        if own:
+            executor = concurrent.futures.ThreadPoolExecutor()
+        futures = []
+        chunk = []
+        size = total = 0
+        try:
+            for s in self.text.lines_from(a, b + 1):
+                chunk.append(s)
+                size += len(s) + 1
+                if size >= self.TRANSFORM_CHUNK:
+                    futures.append(executor.submit(func, chunk))
+                    total += size
+                    chunk = []
+                    size = 0
+            if chunk:
+                futures.append(executor.submit(func, chunk))
+            pending = futures
+            while pending:
+                pending = concurrent.futures.wait(
+                    pending, self.TRANSFORM_POLL)[1]
+                if pending and self._cancelled(cancel):
+                    return None
+            # the last line has no newline
+            return ([f.result() for f in futures], total + size - 1)
+        finally:
+            for f in futures:
+                f.cancel()
+            if own:
+                executor.shutdown(wait=False)
+
+    def _cancelled(self, cancel):
+        """Whether the cancel key has been typed.  Other keys typed
+        meanwhile are kept for _read_keys, those after it dropped."""
+
+        self.win.nodelay(1)
+        try:
+            keys = self._pending_keys()
+        finally:
+            self.win.nodelay(0)
+        if cancel in keys:
+            self._held.extend(keys[:keys.index(cancel)])
+            return True
+        self._held.extend(keys)
+        return False
+
+    def _drop_lines(self, k):
+        "Delete the first k lines as one edit, not recorded for undo."
+
+        old = self._apply(0, 0, self.text.offset(k), '', record=False)
+        self.history.drop_lines(k)
+        self.vpos = _moved(self.vpos, 0, 0, old, '')
+
+    def follow(self, source, encoding='utf-8'):
+        """Append what comes from source while edit() or aedit() waits
+        for keys, until it runs out.
+
+        source is a file descriptor, or an object with fileno(), read
+        when it becomes readable and decoded with encoding; a regular
+        file is read every FOLLOW_POLL seconds and followed past its
+        end, like tail -f.  Or source is an iterator of strings, which
+        may block between items: it is run on a thread of its own (see
+        _drain)."""
+
+        self._follow_file = None
+        if hasattr(source, 'fileno'):
+            # keep the object, which closes its fd when collected
+            self._follow_file = source
+            source = source.fileno()
+        if isinstance(source, int):
+            self._decoder = codecs.getincrementaldecoder(encoding)(
+                'replace')
+            self._queue = None
+            self._follow_polled = stat.S_ISREG(os.fstat(source).st_mode)
+            self.following = source
+        else:
+            self._follow_polled = False
+            (r, w) = os.pipe()
+            self._queue = queue.Queue()
+            threading.Thread(target=self._drain,
+                             args=(iter(source), self._queue, w),
+                             daemon=True).start()
+            self.following = r
+
+    @staticmethod
+    def _drain(source, items, w):
+        """Queue the items of source as they come, writing a byte to
+        the pipe w after each so the reading end can be selected on
+        like a followed file descriptor; None marks the end."""
+
+        try:
+            for s in source:
+                items.put(s)
+                os.write(w, b'\0')
+        finally:
+            items.put(None)
+            os.write(w, b'\0')
+            os.close(w)
+
+    def _pull(self):
+        """Append what the followed source has ready, at most
+        FOLLOW_BATCH bytes or iterator items; stop following at its
+        end, unless it is a regular file.  Returns whether anything was
+        read."""
+
+        source = self.following
+        data = os.read(source, self.FOLLOW_BATCH)
+        if self._follow_polled:
+            if data:
+                s = self._decoder.decode(data)
+                if s:
+                    self.append(s)
+            return bool(data)
+        if self._queue is None:
+            s = self._decoder.decode(data, not data)
+        else:
+            # one item was queued before each byte
+            items = [self._queue.get() for _ in range(len(data))]
+            if items and items[-1] is None:
+                items.pop()
+                data = b''
+            s = ''.join(items)
+        if s:
+            self.append(s)
+        if not data:
+            if self._queue is not None:
+                os.close(source)
+                self._queue = None
+            self.following = None
+            self._follow_file = None
+        return bool(data)
+
+    def _wait_follow(self):
+        """Wait until a key is typed or the followed source has more,
+        and append that.  A regular file is always readable: read it,
+        and if it has nothing new wait for a key for FOLLOW_POLL
+        seconds."""
+
+        source = self.following
+        fd = self.input_fd
+        if fd is None:
+            fd = sys.stdin.fileno()
+        if self._follow_polled:
+            if not self._pull():
+                select.select([fd], [], [], self.FOLLOW_POLL)
+        elif source in select.select([fd, source], [], [])[0]:
+            self._pull()
+
+    def _load_more(self):
+        "Index more of a partially loaded buffer."
+        self.document.load_more()
+
+    def _lines_added(self, first, lengths):
+        "Add the lines indexed from line first on, of the given lengths."
+
+        y = self.lcount.rows_before(first) - self._top_row()
+        self.lcount.splice(first, first,
+                           (l // self.width + 1 for l in lengths))
+        self._states.extend([_STALE] * len(lengths))
+        self._wide.extend(len(lengths))
+        if self._stale is not None:
+            self._stale.extend(bytearray(len(lengths)))
+        self._measure_wide(first)
+        if self.search is not None:
+            self.search.lines_added(self.text, first)
+        self.redraw_vlines(None, (max(y, 0), 0))
+
+    def _place_cursor(self):
+        "Recompute ppos from vpos, scrolling to keep the cursor visible."
+
+        self._reflow_near(self.vpos[0])
+        cell = self._cell(*self.vpos)
+        row = (self.lcount.rows_before(self.vpos[0])
+               + cell // self.width - self._top_row())
+        self.ppos = (row, cell % self.width)
+        if row > self.maxy:
+            self.scroll(row - self.maxy)
+        elif row < 0:
+            self.scroll(row)
+        self._sync_cursor()
+
+    def _sync_cursor(self):
+        """Move the window's cursor to ppos, except while a macro is
+        replayed: render moves it once at the end."""
+
+        if not self.replaying:
+            self.win.move(*self.ppos)
 
     def refresh(self):
+        """Repaint the window, reflowing the text if its width changed.
+
+        Only the lines around the window are reflowed right away; the
+        others are reflowed while waiting for keys (see _reflow_more),
+        so a resize costs time in proportion to the window, not the
+        document.  The cursor stays on the same character."""
 
         # NOTE: texteditpad does not take care of the region outside
         # the Textbox. You need to manually erase characters there
@@ -485,17 +4020,6 @@ class Textbox(object):
             # resize/move window to fit to the new screen size
             # self.stdscr.clear()
             # self.stdscr.refresh()
-            ymax, xmax = self.win.getmaxyx()
-            self.height, self.width = (ymax + 1, xmax + 1)
-            self.vpos = (0, 0)
-            self.ppos = (0, 0)
-            self.vptl = (0, 0)
-            self.lcount = [1] * len(self.text)
-
-            for i in range(len(self.text)):
-                self.lcount[i] = len(self.text[i]) // self.width + 1
-            self.nlines = sum(self.lcount)
-
             # ymax, xmax = self.stdscr.getmaxyx()
             # ncols, nlines = xmax - 5, ymax - 3
             # self.win.resize(nlines, ncols)
@@ -503,48 +4027,622 @@ class Textbox(object):
             # self.win.mvwin(uly, ulx)
             self.win.refresh()
 
-        # recalcualte the line count
         (self.maxy, self.maxx) = self._getmaxyx()
-        (self.height, self.width) = (self.maxy + 1, self.maxx + 1)
-        self.lcount = list([(len(x) // self.width + 1) for x in self.text])
-        self.nlines = sum(self.lcount)
+        self.height = self.maxy + 1
+        if self.maxx + 1 != self.width:
+            (line, col) = self.vptl
+            self.width = self.maxx + 1
+            self._stale = bytearray(b'\x01') * len(self.text)
+            self._reflow_near(line)
+            # keep the character at the top-left corner on the top row
+            sub = self._cell(line, col) // self.width
+            self.vptl = (line, self._row_start(line, sub))
 
         # redraw the texteditbox
         self.redraw_vlines(self.vptl, (0, 0))
 
         # replace the cursor
-        self.win.move(*self.ppos)
+        self._place_cursor()
+        self.render()
 
-    def edit(self, validate=None, debug_mode=False):
-        "Edit in the widget window and collect the results."
-        while 1:
+    def _reflow_near(self, line):
+        """Reflow the lines within twice the window height of line if
+        any of them still have the row counts of an old width."""
 
-            # unicode support: currently disabled
-            if sys.version_info > (3,3):
-                # ch = self.win.get_wch()
-                ch = self.win.getch()
+        if self._stale is None:
+            return
+        a = max(line - 2 * self.height, 0)
+        b = min(line + 2 * self.height + 1, len(self.text))
+        if self._stale.find(b'\x01', a, b) >= 0:
+            self._reflow_lines(a, b)
+
+    def _reflow_lines(self, a, b):
+        "Recompute the row counts of lines a..b-1 for the current width."
+
+        counts = []
+        for i, s in enumerate(self.text.lines_from(a, b), a):
+            if i in self._wide or self.word_wrap and len(s) >= self.width:
+                counts.append(self._measure(i, s))
             else:
-                ch = self.win.getch()
-                
-            if validate:
+                counts.append(len(s) // self.width + 1)
+        self.lcount.splice(a, b, counts)
+        self._stale[a:b] = bytearray(b - a)
+        if self._stale.find(b'\x01') < 0:
+            self._stale = None
+
+    def _reflow_more(self):
+        """Reflow a batch of the lines left with old row counts, the
+        ones nearest the window first.  This changes nothing on the
+        screen."""
+
+        line = self.vptl[0]
+        j = self._stale.find(b'\x01', line)
+        if j >= 0:
+            self._reflow_lines(j, min(j + self.REFLOW_BATCH, len(self.text)))
+        if self._stale is not None:
+            k = self._stale.rfind(b'\x01', 0, line)
+            if k >= 0:
+                self._reflow_lines(max(k + 1 - self.REFLOW_BATCH, 0), k + 1)
+
+    def chunks(self, size=1 << 16):
+        "Yield the contents in blocks of about size characters."
+        return self.text.chunks(size)
+
+    def iter_lines(self):
+        "Yield the lines of the contents one at a time."
+
+        pending = []
+        for chunk in self.text.chunks():
+            parts = chunk.split('\n')
+            pending.append(parts[0])
+            for part in parts[1:]:
+                yield ''.join(pending)
+                pending = [part]
+        yield ''.join(pending)
+
+    def write_to(self, fileobj, encoding=None, size=1 << 16):
+        """Write the contents to fileobj in blocks, without joining them
+        into one string first.
+
+        fileobj needs a write or (for sockets) a sendall method.  Pass
+        encoding when it takes bytes.  Returns the number of characters
+        written."""
+
+        write = getattr(fileobj, 'write', None) or fileobj.sendall
+        n = 0
+        for chunk in self.text.chunks(size):
+            n += len(chunk)
+            write(chunk.encode(encoding) if encoding else chunk)
+        return n
+
+    def _get_key(self):
+        """Read one key with get_wch, or getch if the window has none.
+        Returns -1 when no key is pending in nodelay mode."""
+
+        get_wch = getattr(self.win, 'get_wch', None)
+        if get_wch is None:
+            return self.win.getch()
+        try:
+            ch = get_wch()
+        except curses.error:
+            return -1
+        return ch if isinstance(ch, int) else _as_key(ch)
+
+    def _read_keys(self):
+        """Wait for a key, then collect everything else already typed
+        or pasted without blocking."""
+
+        if self._held:
+            (keys, self._held) = (self._held, [])
+            return keys
+        self.win.nodelay(1)
+        try:
+            # index a partially loaded file, and reflow the lines left
+            # after a resize, while the user is idle
+            ch = self._get_key()
+            while ch == -1 and not (self.text.complete
+                                    and self._stale is None):
+                if self.text.complete:
+                    self._reflow_more()
+                else:
+                    self._load_more()
+                self.render()
+                ch = self._get_key()
+            while ch == -1 and self.following is not None:
+                self._wait_follow()
+                self.render_all()
+                ch = self._get_key()
+            if ch == -1:
+                self.win.nodelay(0)
+                ch = self._get_key()
+                self.win.nodelay(1)
+            keys = [ch]
+            while 1:
+                ch = self._get_key()
+                if ch == -1:
+                    # wait for the rest of a split paste marker
+                    if self.bracketed_paste and _partial_marker(keys):
+                        self.win.nodelay(0)
+                        keys.append(self._get_key())
+                        self.win.nodelay(1)
+                        continue
+                    break
+                keys.append(ch)
+        finally:
+            self.win.nodelay(0)
+        return keys
+
+    def _pending_keys(self):
+        "Collect the keys already typed or pasted, without waiting."
+
+        keys = []
+        ch = self._get_key()
+        while ch != -1:
+            keys.append(ch)
+            ch = self._get_key()
+        return keys
+
+    def _scan_paste(self, keys):
+        "Yield keys, replacing paste markers with True/False."
+
+        i = 0
+        while i < len(keys):
+            if keys[i] == curses.ascii.ESC:
+                marker = tuple(keys[i:i + len(_PASTE_START)])
+                if marker in (_PASTE_START, _PASTE_END):
+                    yield marker == _PASTE_START
+                    i += len(marker)
+                    continue
+            yield keys[i]
+            i += 1
+
+    def feed(self, keys, validate=None):
+        """Process a batch of keys and repaint once.
+
+        Runs of printable characters and newlines, and the contents of
+        bracketed pastes, are inserted with a single insert_text call,
+        or overwrite_text in overwrite mode.  Returns 0 if a key
+        terminated editing, 1 otherwise."""
+
+        try:
+            return self._feed(keys, validate)
+        finally:
+            self.render_all()
+
+    def _feed(self, keys, validate=None):
+        "feed without the repaint."
+
+        run = []
+        recording = self.recording
+        for ch in self._scan_paste(keys):
+            if ch is True or ch is False:
+                # a paste is undone on its own
+                self._flush_run(run)
+                self.history.seal()
+                self.pasting = ch
+                self._paste_cr = False
+                if recording is not None:
+                    recording.extend(_PASTE_START if ch else _PASTE_END)
+                continue
+            if self.pasting:
+                if recording is not None:
+                    recording.append(ch)
+                if ch == curses.ascii.NL and self._paste_cr:
+                    self._paste_cr = False  # the LF of a CR LF
+                    continue
+                self._paste_cr = ch == curses.ascii.CR
+                if ch in (curses.ascii.CR, curses.ascii.NL):
+                    run.append('\n')
+                elif ch == curses.ascii.HT:
+                    run.append('\t')
+                elif _printable(ch):
+                    run.append(_key_text(ch))
+                continue
+            if validate and ch != curses.ascii.NUL:
                 ch = validate(ch)
-            if not ch:
+                if not ch:
+                    continue
+            if recording is not None:
+                recording.append(ch)
+            if self.insert_mode and self.search is None \
+               and self.replacing is None and self.prefix is None and (
+                    _printable(ch) or (
+                        ch == curses.ascii.NL and self.height > 1)):
+                run.append(_key_text(ch))
                 continue
-            if not self.do_command(ch):
-                break
+            self._flush_run(run)
+            if not self._run_command(ch):
+                return 0
+            # ^x ( and ^x ) start and stop recording
+            recording = self.recording
+        self._flush_run(run)
+        return 1
+
+    def _flush_run(self, run):
+        if len(run) == 1 and not self.pasting \
+           or run and self.search is not None:
+            # text pasted during a search extends the search string
+            for ch in run:
+                self._run_command(_as_key(ch))
+        elif run:
+            self.lastcmd = _as_key(run[-1])
+            # what _do_command resets before each of the keys
+            self.count = None
+            self._yanked = None
+            if self.recording is not None:
+                self._command_start = len(self.recording) - 1
+            # typed runs are only collected in insert mode
+            insert = self.insert_text if self.insert_mode \
+                else self.overwrite_text
+            if self.metrics is None:
+                insert(''.join(run))
+            else:
+                t = _clock()
+                insert(''.join(run))
+                self.metrics.time('insert_text', _clock() - t)
+                self.metrics.keys += len(run)
+        del run[:]
+
+    def edit(self, validate=None, debug_mode=False, bracketed_paste=False,
+             collect=True):
+        """Edit in the widget window and collect the results.
+
+        Keys are read in batches: whatever is pending after the first
+        key is processed together and repainted once.  With
+        bracketed_paste the terminal is asked to mark pasted text, which
+        is then inserted verbatim, except that CR LF and lone CRs become
+        newlines.  With collect=False nothing is
+        returned; stream the result with chunks, iter_lines or
+        write_to instead of building one string."""
+
+        self.bracketed_paste = bracketed_paste
+        if bracketed_paste:
+            sys.stdout.write(_PASTE_ON)
+            sys.stdout.flush()
+        try:
+            while 1:
+                if not self.feed(self._read_keys(), validate):
+                    break
+
+                if debug_mode:
+                    (backy, backx) = self.win.getyx()
+                    maxy, maxx = self._getmaxyx()
+                    self.win.addstr(maxy, 0, ' ' * maxx)
+                    self.win.addstr(maxy, 0, '%r %d %d %d %d'
+                                    % (self.lastcmd, self.vpos[0],
+                                       self.vpos[1], self.ppos[0],
+                                       self.ppos[1]))
+                    self.win.refresh()
+                    self.win.move(backy, backx)
+        finally:
+            if bracketed_paste:
+                sys.stdout.write(_PASTE_OFF)
+                sys.stdout.flush()
+
+        if collect:
+            return self.text.getvalue()
+
+    async def aedit(self, validate=None, bracketed_paste=False,
+                    collect=True, fd=None):
+        """Edit without blocking the running asyncio event loop.
+
+        Returns what edit() would return.  Keys are read when fd (stdin
+        by default) becomes readable, and each batch is processed and
+        repainted at once, so other tasks keep running while the user
+        types.  Keys kept back while a transform ran are processed
+        first.  Indexing a large file and reflowing after a resize go
+        on a batch at a time between events.  Cancelling the task ends
+        editing.  A resize is noticed with the next key.  A source being
+        followed (see follow) is read when it has more.  fd defaults to
+        the textbox's input_fd."""
 
-            if debug_mode:
-                (backy, backx) = self.win.getyx()
-                maxy, maxx = self._getmaxyx()
-                self.win.addstr(maxy, 0, ' ' * maxx)
-                self.win.addstr(maxy, 0, '%d %d %d %d %d'
-                                % (ch, self.vpos[0], self.vpos[1],
-                                   self.ppos[0], self.ppos[1]))
-                # self.win.addstr(maxy, 0, str(self.lnbg))
+        loop = asyncio.get_running_loop()
+        if fd is None:
+            fd = self.input_fd
+        if fd is None:
+            fd = sys.stdin.fileno()
+        future = loop.create_future()
+        carry = []  # beginning of a paste marker split between reads
+        idle = [None]  # handle of the scheduled background step
+
+        source = self.following  # read by pulled()
+        polled = self._follow_polled  # read by pulled() on a timer
+        timer = [None]
+
+        def background():
+            idle[0] = None
+            if not self.text.complete:
+                self._load_more()
+            else:
+                self._reflow_more()
+            self.render()
+            schedule()
+
+        def schedule():
+            if idle[0] is None and not future.done() \
+               and not (self.text.complete and self._stale is None):
+                idle[0] = loop.call_soon(background)
+
+        def pulled():
+            if future.done():
+                return
+            try:
+                if self._pull():
+                    self.render_all()
+                    self.win.refresh()
+                if self.following is None:
+                    loop.remove_reader(source)
+                elif polled:
+                    # regular files cannot be waited on with epoll
+                    timer[0] = loop.call_later(self.FOLLOW_POLL, pulled)
+            except Exception as e:
+                future.set_exception(e)
+
+        def readable():
+            if future.done():
+                return
+            try:
+                # keys _cancelled kept back came before the pending ones
+                (held, self._held) = (self._held, [])
+                self.win.nodelay(1)  # _cancelled turns it off
+                keys = carry + held + self._pending_keys()
+                del carry[:]
+                n = self.bracketed_paste and _partial_marker(keys)
+                if n:
+                    carry.extend(keys[-n:])
+                    del keys[-n:]
+                if keys and not self.feed(keys, validate):
+                    future.set_result(
+                        self.text.getvalue() if collect else None)
+                    return
                 self.win.refresh()
-                self.win.move(backy, backx)
+            except Exception as e:
+                future.set_exception(e)
+                return
+            if self._held:
+                loop.call_soon(readable)
+            schedule()
+
+        def done(future):
+            loop.remove_reader(fd)
+            if polled:
+                if timer[0] is not None:
+                    timer[0].cancel()
+            elif source is not None:
+                loop.remove_reader(source)
+            if idle[0] is not None:
+                idle[0].cancel()
+            self.win.nodelay(0)
+            if bracketed_paste:
+                sys.stdout.write(_PASTE_OFF)
+                sys.stdout.flush()
+
+        self.bracketed_paste = bracketed_paste
+        if bracketed_paste:
+            sys.stdout.write(_PASTE_ON)
+            sys.stdout.flush()
+        self.win.nodelay(1)
+        loop.add_reader(fd, readable)
+        if polled:
+            loop.call_soon(pulled)
+        elif source is not None:
+            loop.add_reader(source, pulled)
+        future.add_done_callback(done)
+        # keys typed before the call
+        loop.call_soon(readable)
+        return await future
+
+
+class VirtualWindow(object):
+
+    """In-memory stand-in for the curses window methods Textbox uses.
+
+    Keys to be returned by getch or get_wch are taken from `keys`;
+    once they run out getch returns -1 (get_wch raises curses.error) in
+    nodelay mode and both raise EOFError otherwise.  `calls` counts how
+    often each window method was called and `lines()` returns the
+    current screen contents.  A wide character fills two cells: its
+    own and an empty one after it.  `attrs` holds one dict per row
+    mapping columns to the attributes set by chgat; writing to a row
+    clears them from the written column on.
+    """
+
+    def __init__(self, nlines, ncols, keys=()):
+        self.nlines, self.ncols = nlines, ncols
+        self.cells = [[' '] * ncols for _ in range(nlines)]
+        self.attrs = [{} for _ in range(nlines)]
+        self.y = self.x = 0
+        self.keys = list(reversed(list(keys)))
+        self.delay = True
+        self.scrolling = False
+        self.calls = {}
+
+    def _count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def _check(self, y, x):
+        if not (0 <= y < self.nlines and 0 <= x < self.ncols):
+            raise curses.error('position (%d, %d) outside window' % (y, x))
+
+    def _put(self, s):
+        "Write s at the cursor, advancing it like waddch."
+
+        attrs = self.attrs[self.y]
+        if attrs:
+            for x in [x for x in attrs if x >= self.x]:
+                del attrs[x]
+
+        if _MAYBE_WIDE.search(s) is None:
+            for c in s:
+                self.cells[self.y][self.x] = c
+                if self.x + 1 < self.ncols:
+                    self.x += 1
+                elif self.y + 1 < self.nlines:
+                    self.y, self.x = self.y + 1, 0
+                else:
+                    raise curses.error('write past the lower-right corner')
+            return
+        last = None
+        for c in s:
+            w = _char_width(c)
+            if w == 0:
+                # combines with the character before it
+                if last is not None:
+                    self.cells[last[0]][last[1]] += c
+                continue
+            if self.x + w > self.ncols:
+                # a wide character does not fit: continue on the next row
+                if self.y + 1 == self.nlines:
+                    raise curses.error('write past the lower-right corner')
+                self.y, self.x = self.y + 1, 0
+            last = (self.y, self.x)
+            self.cells[self.y][self.x:self.x + w] = [c] + [''] * (w - 1)
+            self._advance(w)
+
+    def _advance(self, w):
+        if self.x + w < self.ncols:
+            self.x += w
+        elif self.y + 1 < self.nlines:
+            self.y, self.x = self.y + 1, 0
+        else:
+            raise curses.error('write past the lower-right corner')
+
+    def push_keys(self, keys):
+        "Queue more keys for getch."
+        self.keys[:0] = reversed(list(keys))
+
+    def lines(self):
+        "Screen contents, one string per row."
+        return [''.join(row) for row in self.cells]
+
+    def getmaxyx(self):
+        return self.nlines, self.ncols
+
+    def getyx(self):
+        return self.y, self.x
+
+    def keypad(self, flag):
+        self._count('keypad')
+
+    def idlok(self, flag):
+        self._count('idlok')
+
+    def scrollok(self, flag):
+        self._count('scrollok')
+        self.scrolling = bool(flag)
+
+    def nodelay(self, flag):
+        self._count('nodelay')
+        self.delay = not flag
+
+    def refresh(self):
+        self._count('refresh')
+
+    def noutrefresh(self):
+        self._count('noutrefresh')
+
+    def move(self, y, x):
+        self._count('move')
+        self._check(y, x)
+        self.y, self.x = y, x
+
+    def addch(self, y, x, ch):
+        self._count('addch')
+        self._check(y, x)
+        self.y, self.x = y, x
+        if isinstance(ch, bytes):
+            ch = ch.decode()
+        elif not isinstance(ch, str):
+            ch = chr(ch)
+        self._put(ch)
+
+    def addnstr(self, y, x, s, n, attr=0):
+        self._count('addnstr')
+        self._check(y, x)
+        self.y, self.x = y, x
+        self._put(s[:n] if n >= 0 else s)
+
+    def addstr(self, y, x, s, attr=0):
+        self._count('addstr')
+        self._check(y, x)
+        self.y, self.x = y, x
+        self._put(s)
+
+    def insnstr(self, y, x, s, n, attr=0):
+        self._count('insnstr')
+        self._check(y, x)
+        s = s[:n] if n >= 0 else s
+        cells = []
+        for c in s:
+            w = 1 if c < u'\u0300' else _char_width(c)
+            if w == 0 and cells:
+                cells[-1] += c
+            elif w:
+                cells += [c] + [''] * (w - 1)
+        row = self.cells[y]
+        row[x:x] = cells
+        del row[self.ncols:]
+        self.attrs[y] = dict((c + len(cells) if c >= x else c, a)
+                             for c, a in self.attrs[y].items()
+                             if c + len(cells) < self.ncols or c < x)
+        self.y, self.x = y, x
+
+    def chgat(self, y, x, n, attr):
+        self._count('chgat')
+        self._check(y, x)
+        stop = self.ncols if n < 0 else min(x + n, self.ncols)
+        for c in range(x, stop):
+            self.attrs[y][c] = attr
+
+    def scrl(self, n):
+        self._count('scrl')
+        if not self.scrolling:
+            raise curses.error('scrollok is not set')
+        blank = [[' '] * self.ncols for _ in range(abs(n))]
+        plain = [{} for _ in range(abs(n))]
+        if n > 0:
+            self.cells = self.cells[n:] + blank
+            self.attrs = self.attrs[n:] + plain
+        elif n < 0:
+            self.cells = blank + self.cells[:n]
+            self.attrs = plain + self.attrs[:n]
+        del self.cells[self.nlines:]
+        del self.attrs[self.nlines:]
+
+    def insdelln(self, n):
+        self._count('insdelln')
+        y = self.y
+        blank = [[' '] * self.ncols for _ in range(abs(n))]
+        plain = [{} for _ in range(abs(n))]
+        if n > 0:
+            self.cells[y:y] = blank
+            self.attrs[y:y] = plain
+            del self.cells[self.nlines:]
+            del self.attrs[self.nlines:]
+        else:
+            del self.cells[y:y - n]
+            del self.attrs[y:y - n]
+            self.cells[self.nlines + n:] = blank
+            self.attrs[self.nlines + n:] = plain
+
+    def getch(self):
+        self._count('getch')
+        if self.keys:
+            return self.keys.pop()
+        if self.delay:
+            raise EOFError('no more keys')
+        return -1
 
-        return '\n'.join(self.text)
+    def get_wch(self):
+        self._count('get_wch')
+        if self.keys:
+            ch = self.keys.pop()
+            if isinstance(ch, int) and ch < curses.KEY_MIN:
+                ch = chr(ch)
+            return ch
+        if self.delay:
+            raise EOFError('no more keys')
+        raise curses.error('no input')
 
 
 class EscapePressed(Exception):